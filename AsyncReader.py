@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Tran Minh Quan, quantm@unist.ac.kr
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# Read files ahead of time from an asyncio loop running in a background thread.
+# The reads themselves are blocking (skimage, tifffile) and run on a bounded
+# thread pool, so a slow network mount overlaps with the augmentation and the
+# compositing of the current sample instead of stalling it.
+
+import os, glob, time, threading, asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from natsort import natsorted
+
+###################################################################################################
+_LISTINGS = {}
+
+def list_files(path, pattern='*.*', refresh=False):
+	"""Sorted glob of path/pattern, listed once per process."""
+	key = (path, pattern)
+	if refresh or key not in _LISTINGS:
+		_LISTINGS[key] = natsorted(glob.glob(os.path.join(path, pattern)))
+	return _LISTINGS[key]
+
+###################################################################################################
+class AsyncReader(object):
+	"""
+	submit(path) starts reading path with read(path) and returns a handle, result(handle)
+	waits for it. At most concurrency reads run at once.
+	Create it in the process that uses it, the loop thread does not survive a fork.
+	"""
+	def __init__(self, read, concurrency=4):
+		self.read        = read
+		self.concurrency = concurrency
+		self.executor    = ThreadPoolExecutor(max_workers=concurrency)
+		self.loop        = asyncio.new_event_loop()
+		self.thread      = threading.Thread(target=self.loop.run_forever, name='AsyncReader')
+		self.thread.daemon = True
+		self.thread.start()
+		self.semaphore   = asyncio.run_coroutine_threadsafe(self._make_semaphore(), self.loop).result()
+
+		self.pending     = set()
+		self.in_flight   = 0
+		self.nr_reads    = 0
+		self.nr_hits     = 0
+		self.nr_results  = 0
+		self.read_time   = 0.0
+		self.wait_time   = 0.0
+		self.lock        = threading.Lock()
+
+	async def _make_semaphore(self):
+		return asyncio.Semaphore(self.concurrency)
+
+	async def _read(self, path, read):
+		async with self.semaphore:
+			with self.lock:
+				self.in_flight += 1
+			start = time.time()
+			try:
+				return await self.loop.run_in_executor(self.executor, read, path)
+			finally:
+				with self.lock:
+					self.in_flight -= 1
+					self.nr_reads  += 1
+					self.read_time += time.time() - start
+
+	def submit(self, path, read=None):
+		# read overrides the reader function for this path
+		future = asyncio.run_coroutine_threadsafe(self._read(path, read or self.read), self.loop)
+		self.pending.add(future)
+		return future
+
+	def result(self, future):
+		self.nr_results += 1
+		if future.done():
+			self.nr_hits += 1
+		start = time.time()
+		try:
+			return future.result()
+		finally:
+			self.wait_time += time.time() - start
+			self.pending.discard(future)
+
+	def stats(self):
+		"""
+		queued:    submitted and not consumed yet
+		ready:     read and waiting for the consumer
+		in_flight: being read right now
+		hit_rate:  fraction of the results that were ready when asked for
+		"""
+		ready = sum(1 for future in self.pending if future.done())
+		return {
+			'queued':    len(self.pending),
+			'ready':     ready,
+			'in_flight': self.in_flight,
+			'reads':     self.nr_reads,
+			'hit_rate':  self.nr_hits / float(max(self.nr_results, 1)),
+			'read_time': self.read_time / max(self.nr_reads, 1),
+			'wait_time': self.wait_time,
+			}
+
+	def close(self):
+		self.loop.call_soon_threadsafe(self.loop.stop)
+		self.thread.join()
+		self.executor.shutdown(wait=False)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Tran Minh Quan, quantm@unist.ac.kr
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# Host-side augmentation of the styles and volumes
+
+import numpy as np
+
+###################################################################################################
+# Flips and 90 degree turns
+#
+# random_flip, random_reverse and random_square_rotate only ever flip the two image axes and
+# turn by multiples of 90 degrees, so any chain of them is one of the 8 symmetries of the square:
+# flip rows or not, flip columns or not, then swap the two axes or not. That is a strided view,
+# no interpolation and no copy.
+def dihedral(flip=4, reverse=1, rotate=0):
+	"""
+	Compose the choices of random_flip (1-4), random_reverse (1-2) and random_square_rotate
+	(0-3 quarter turns) into (flip_y, flip_x, transpose).
+	"""
+	flip_y = flip in (2, 3)
+	flip_x = flip in (1, 3)
+	flip_y ^= reverse == 2
+	# np.rot90 with axes (0, 1): one quarter turn flips the columns and then swaps the axes
+	rotate = rotate % 4
+	if rotate == 1:
+		flip_x = not flip_x
+	elif rotate == 2:
+		flip_y, flip_x = not flip_y, not flip_x
+	elif rotate == 3:
+		flip_y = not flip_y
+	return (bool(flip_y), bool(flip_x), rotate % 2 == 1)
+
+def apply_dihedral(image, transform):
+	"""View of image [y, x, ...] under transform, copy it if it has to be contiguous."""
+	flip_y, flip_x, transpose = transform
+	view = image[::-1 if flip_y else 1, ::-1 if flip_x else 1]
+	if transpose:
+		view = view.swapaxes(0, 1)
+	return view
+
+###################################################################################################
+# Elastic deformation
+class ElasticWarp(object):
+	"""
+	Smooth random displacements: a coarse size x size field of amplitude ampl, pinned to zero
+	at the border, upsampled to the image. The coordinate grids are cached per shape, and all
+	the channels of an image (e.g. the slices of a volume) are remapped by one cv2.remap.
+	"""
+	def __init__(self, size=(4, 16), ampl=(2, 5), order=0):
+		self.size  = size
+		self.ampl  = ampl
+		self.order = order
+		self.grids = {}
+
+	def grid(self, shape):
+		if shape not in self.grids:
+			self.grids[shape] = tuple(g.astype(np.float32) for g in np.indices(shape))
+		return self.grids[shape]
+
+	def coarse_field(self, rng, ndim):
+		size = int(rng.integers(*self.size))
+		ampl = int(rng.integers(*self.ampl))
+		field = rng.uniform(-ampl, ampl, size=(ndim,) + (size,)*ndim).astype(np.float32)
+		# Do not distort at the boundary
+		for axis in range(1, ndim+1):
+			index = [slice(None)] * (ndim+1)
+			index[axis] = [0, -1]
+			field[tuple(index)] = 0
+		return field
+
+	def warp(self, image, rng):
+		"""image [y, x] or [y, x, c], every channel gets the same displacement."""
+		import cv2
+		height, width = image.shape[:2]
+		du, dv = self.coarse_field(rng, 2)
+		rows, cols = self.grid((height, width))
+		map_y = rows + cv2.resize(du, (width, height))
+		map_x = cols + cv2.resize(dv, (width, height))
+		interpolation = cv2.INTER_NEAREST if self.order == 0 else cv2.INTER_LINEAR
+		def remap(channels):
+			return cv2.remap(channels, map_x, map_y, interpolation, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+		if image.ndim == 2 or image.shape[2] <= 512:
+			warped = remap(np.ascontiguousarray(image))
+			return warped.reshape(image.shape)
+		# cv2 caps the number of channels at 512
+		return np.concatenate([remap(np.ascontiguousarray(image[..., c:c+512])).reshape(image.shape[:2] + (-1,))
+							   for c in range(0, image.shape[2], 512)], axis=-1)
+
+	def warp_volume(self, volume, rng):
+		"""volume [z, y, x], a 3D displacement resampled by one map_coordinates call."""
+		from scipy.ndimage import map_coordinates, zoom
+		field = self.coarse_field(rng, 3)
+		coords = self.grid(volume.shape)
+		factors = [n / float(field.shape[1+k]) for k, n in enumerate(volume.shape)]
+		displaced = [coords[k] + zoom(field[k], factors, order=1) for k in range(3)]
+		return map_coordinates(volume, displaced, order=self.order, mode='constant', cval=0)
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Tran Minh Quan, quantm@unist.ac.kr
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# Cache of compressed bricks shared by the prefetch workers, so dozens of volumes stay hot
+# without every worker decoding its own TIFFs or holding their voxels.
+# Volumes are cut into bricks of BRICK^3 voxels, compressed with zlib (level 1) into the pages of
+# an anonymous shared mapping. Create the cache before the workers fork, they all inherit it.
+# A read only decompresses the bricks it touches, the least recently used bricks are evicted.
+# The slots are grouped in buckets of WAYS, a brick only goes in the bucket of the hash of its
+# key, so a lookup scans WAYS slots.
+#
+# Arena layout, every table 64-byte aligned:
+#   clock               int64, ticks of the last use
+#   keys, sizes, ticks  one row per slot, a slot holds one brick (compressed size 0 is a free slot)
+#   pages               [slots, max_pages] pages of the brick, in order
+#   used                [nr_pages] bool
+#   data                [nr_pages, page]
+
+import os, json, zlib, mmap, contextlib
+import multiprocessing as mp
+
+import numpy as np
+
+from VolumeReader import open_volume, read_window, _bounds
+
+###################################################################################################
+BRICK = 32
+PAGE  = 4096
+WAYS  = 8
+
+def _aligned(nbytes):
+	return -(-nbytes // 64) * 64
+
+class BrickCache(object):
+	"""
+	capacity bytes of pages holding compressed bricks of brick^3 voxels of at most itemsize bytes
+	(uint16 by default). get and put are atomic across the processes that forked from the creator.
+	"""
+	def __init__(self, capacity=1 << 30, brick=BRICK, level=1, page=PAGE, itemsize=2):
+		self.brick      = brick
+		self.level      = level
+		self.page       = page
+		self.itemsize   = itemsize
+		self.nr_pages   = max(capacity // page, 1)
+		self.nr_buckets = max(self.nr_pages // 2 // WAYS, 1)
+		self.nr_slots   = self.nr_buckets * WAYS
+		raw             = brick ** 3 * itemsize
+		self.max_pages  = -(-(raw + raw // 1000 + 64) // page) # zlib worst case
+		tables = [('clock', np.int64, (1,)),
+				  ('keys',  np.uint64, (self.nr_slots,)),
+				  ('sizes', np.int32, (self.nr_slots,)),
+				  ('ticks', np.int64, (self.nr_slots,)),
+				  ('pages', np.int32, (self.nr_slots, self.max_pages)),
+				  ('used',  np.bool_, (self.nr_pages,)),
+				  ('data',  np.uint8, (self.nr_pages, page))]
+		offsets, total = [], 0
+		for _, dtype, shape in tables:
+			offsets.append(total)
+			total += _aligned(int(np.prod(shape)) * np.dtype(dtype).itemsize)
+		# Anonymous shared mapping, inherited by the forked workers and zeroed: every slot is free
+		self.arena = mmap.mmap(-1, total)
+		for (name, dtype, shape), offset in zip(tables, offsets):
+			setattr(self, name, np.frombuffer(self.arena, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape))
+		self.lock   = mp.Lock()
+		self.hits   = 0 # Of this process
+		self.misses = 0
+
+	def _bucket(self, key):
+		# Slots of the bucket of key, Fibonacci hashing spreads the bricks of a volume
+		bucket = ((int(key) * 0x9E3779B97F4A7C15) & 0xffffffffffffffff) >> 32
+		start = bucket % self.nr_buckets * WAYS
+		return slice(start, start + WAYS)
+
+	def _find(self, key, ways):
+		slots = np.flatnonzero((self.keys[ways] == key) & (self.sizes[ways] > 0))
+		return ways.start + int(slots[0]) if len(slots) else None
+
+	def get(self, key):
+		"""Decompressed bytes of the brick key, None when it is not cached."""
+		ways = self._bucket(key)
+		with self.lock:
+			slot = self._find(key, ways)
+			if slot is None:
+				self.misses += 1
+				return None
+			self.hits += 1
+			self.clock[0] += 1
+			self.ticks[slot] = self.clock[0]
+			size = int(self.sizes[slot])
+			data = self.data[self.pages[slot, :-(-size // self.page)]].reshape(-1)[:size].tobytes()
+		return zlib.decompress(data)
+
+	def put(self, key, raw):
+		"""Cache the bytes raw of the brick key, unless they do not compress into max_pages pages."""
+		data = zlib.compress(raw, self.level)
+		need = -(-len(data) // self.page)
+		if need > min(self.max_pages, self.nr_pages):
+			return False
+		chunk = np.zeros(need * self.page, dtype=np.uint8)
+		chunk[:len(data)] = np.frombuffer(data, dtype=np.uint8)
+		ways = self._bucket(key)
+		with self.lock:
+			if self._find(key, ways) is not None: # Another worker was faster
+				return True
+			self._evict(need, ways)
+			slot = ways.start + int(np.flatnonzero(self.sizes[ways] == 0)[0])
+			pages = np.flatnonzero(~self.used)[:need]
+			self.used[pages] = True
+			self.data[pages] = chunk.reshape(need, self.page)
+			self.pages[slot, :need] = pages
+			self.keys[slot] = key
+			self.sizes[slot] = len(data)
+			self.clock[0] += 1
+			self.ticks[slot] = self.clock[0]
+		return True
+
+	def _evict(self, need, ways):
+		# Free the least recently used slots until need pages and a slot of ways are free, under the lock
+		lacking = need - (self.nr_pages - int(np.count_nonzero(self.used)))
+		if lacking > 0:
+			# The oldest ones freeing the pages lacking, or 1/64 of the pages so the sort is rare
+			valid = np.flatnonzero(self.sizes > 0)
+			victims = valid[np.argsort(self.ticks[valid])]
+			freed = np.cumsum(-(-self.sizes[victims] // self.page))
+			self._free(victims[:int(np.searchsorted(freed, max(lacking, self.nr_pages // 64))) + 1])
+		if self.sizes[ways].all():
+			self._free(np.array([ways.start + int(np.argmin(self.ticks[ways]))]))
+
+	def _free(self, victims):
+		counts = -(-self.sizes[victims] // self.page)
+		self.used[self.pages[victims][np.arange(self.max_pages) < counts[:, None]]] = False
+		self.sizes[victims] = 0
+
+	def stats(self):
+		used = int(np.count_nonzero(self.used))
+		return {'bricks': int(np.count_nonzero(self.sizes)), 'pages': used, 'mbytes': used * self.page / 2.0**20,
+				'hits': self.hits, 'misses': self.misses}
+
+###################################################################################################
+class CachedVolume(object):
+	"""
+	Lazy volume (see VolumeReader) of path read brick by brick through cache. Missing bricks are
+	read from the volume one layer of bricks at a time and cached for every process. The shape and
+	dtype are cached too, the volume is only opened on the first missing brick.
+	"""
+	def __init__(self, path, cache):
+		self.path   = path
+		self.source = None
+		self.cache  = cache
+		# Bricks of a changed volume get new keys, the old ones age out
+		name = '{}:{}'.format(os.path.abspath(path), os.path.getmtime(path))
+		self.id = zlib.crc32(name.encode('utf-8')) & 0xffffffff
+		key = np.uint64((self.id << 32) | 0xffffffff) # Past the last brick
+		meta = cache.get(key)
+		if meta is None:
+			source = self.open()
+			meta = json.dumps({'shape': [int(n) for n in source.shape], 'dtype': source.dtype.str}).encode('utf-8')
+			cache.put(key, meta)
+		meta = json.loads(meta.decode('utf-8'))
+		self.shape = tuple(meta['shape'])
+		self.dtype = np.dtype(meta['dtype'])
+		assert self.dtype.itemsize <= cache.itemsize, \
+			'{} voxels of {} do not fit the bricks of the cache, make it with itemsize={}'.format(
+				self.dtype, path, self.dtype.itemsize)
+		self.grid = tuple(-(-n // cache.brick) for n in self.shape)
+
+	def open(self):
+		if self.source is None:
+			self.source = open_volume(self.path)
+		return self.source
+
+	def close(self):
+		if self.source is not None:
+			self.source.close()
+			self.source = None
+
+	def key(self, i, j, k):
+		return np.uint64((self.id << 32) | ((i * self.grid[1] + j) * self.grid[2] + k))
+
+	def read(self, z=slice(None), y=slice(None), x=slice(None)):
+		b = self.cache.brick
+		bounds = [_bounds(s, n) for s, n in zip((z, y, x), self.shape)]
+		out = np.empty([hi - lo for lo, hi in bounds], dtype=self.dtype)
+		grids = [range(lo // b, -(-hi // b)) for lo, hi in bounds]
+		rows = slice(grids[1][0] * b, min(grids[1][-1] * b + b, self.shape[1])) if len(grids[1]) else slice(0, 0)
+		cols = slice(grids[2][0] * b, min(grids[2][-1] * b + b, self.shape[2])) if len(grids[2]) else slice(0, 0)
+		for i in grids[0]:
+			layer = None # Read from the volume on the first missing brick of this layer
+			for j in grids[1]:
+				for k in grids[2]:
+					origin = (i * b, j * b, k * b)
+					window = tuple(slice(o, min(o + b, n)) for o, n in zip(origin, self.shape))
+					raw = self.cache.get(self.key(i, j, k))
+					if raw is None:
+						if layer is None:
+							layer = self.open().read(z=window[0], y=rows, x=cols)
+						brick = np.ascontiguousarray(layer[:, window[1].start - rows.start:window[1].stop - rows.start,
+															  window[2].start - cols.start:window[2].stop - cols.start])
+						self.cache.put(self.key(i, j, k), brick.tobytes())
+					else:
+						brick = np.frombuffer(raw, dtype=self.dtype).reshape([w.stop - w.start for w in window])
+					src, dst = [], []
+					for w, (lo, hi) in zip(window, bounds):
+						a, c = max(w.start, lo), min(w.stop, hi)
+						src.append(slice(a - w.start, c - w.start))
+						dst.append(slice(a - lo, c - lo))
+					out[tuple(dst)] = brick[tuple(src)]
+		return out
+
+def read_cached(path, shape, crop=(0.5, 0.5, 0.5), cache=None):
+	"""VolumeReader.read_volume through the BrickCache cache."""
+	with contextlib.closing(CachedVolume(path, cache)) as volume:
+		return read_window(volume, shape, crop)
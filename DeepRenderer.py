@@ -6,7 +6,8 @@ from __future__ import division
 from __future__ import print_function
 
 
-import os, sys, argparse, glob, cv2, six
+import os, sys, argparse, glob, cv2, six, contextlib, copy, multiprocessing, time, collections
+import functools
 
 
 
@@ -30,8 +31,23 @@ from tensorpack.utils.utils import get_rng
 from tensorpack.tfutils import optimizer, gradproc
 from tensorpack.tfutils.summary import add_moving_summary, add_param_summary
 from tensorpack.tfutils.scope_utils import auto_reuse_variable_scope
+from tensorpack.tfutils.argscope import get_arg_scope
+from tensorpack.models.registry import get_registered_layer
 from tensorpack.utils import logger
 
+from SharedPrefetch import PrefetchDataSHM, ALIGNMENT, get_worker_info
+from AsyncReader import AsyncReader, list_files
+from Augment import dihedral, apply_dihedral, ElasticWarp
+from GraphCompositor import graph_project, composite_over
+from TransferFunction import LUTBank, parse_rgba_transfer_function
+from VolumeReader import open_volume, read_volume, bounding_box, window_start, VolumeIndex
+from VolumeCompositor import over, over_fixed, check_fixed, verify_fixed, over_rgba, composite_volume, gray_to_rgb, apply_lut, transparent_zero, place, rotate_content, project_intensity, PROJECTION_MODES
+from VolumePyramid import PYRAMID_MODES, read_level
+from BrickCache import BrickCache, read_cached
+from Shading import Shader
+from SparseVolume import SparseVolume, sparse_volume
+from PreIntegration import get_table, composite_preintegrated, benchmark as preintegration_benchmark
+
 
 ###################################################################################################
 EPOCH_SIZE = 10
@@ -41,13 +57,120 @@ DIMX  = 256
 DIMY  = 256
 DIMZ  = 256
 DIMC  = 1
+####################################################################################################
+class GeneratorConfig(object):
+	"""
+	Everything that differs between the generator variants.
+
+	kernel_shape:   kernel size of every conv in the generator
+	stride:         stride of the conv_i at each encoder scale
+	scale:          upsampling factor of the Subpix2D at each decoder scale
+	renderer:       how the ground-truth projection is made, 'numpy' or 'vtk'
+	nr_prefetch:    number of processes prefetching the training dataflow
+	checkpoint:     scales (0 is the finest) whose residual blocks are recomputed in backprop
+	encoding:       input encoding of the volume slices, see encode_input
+	encoding_depth: slices kept per channel group by the input encoding
+	input_dtype:    dtype the volume is shipped in, 'float32' or 'uint8'
+	min_resolution: smallest volume or patch size the graph sees, anything but DIMX makes the 
+	                spatial dims dynamic
+	patch_size:     train on patch_size x patch_size columns of the volume instead of whole frames
+	data_format:    layout of the generator and VGG19 tower, 'NHWC', 'NCHW' or 'auto' to time both
+	graph_augment:  ship the raw uint8 volume and its angle, rotate and composite in the graph
+	volume_depth:   when > 0 the generator predicts color and alpha of volume_depth slices, which 
+	                composite_over turns into the rendering
+	volume_alpha:   weight of the L1 loss between the predicted alphas and the transfer function
+	lut_input:      feed the transfer function of each sample to the generator, see LUTBank
+	projection_input: feed the projection mode of each sample (one-hot over PROJECTION_MODES) to 
+	                the generator, when the ground truth mixes several modes
+	"""
+	def __init__(self, kernel_shape=3, stride=2, scale=2, renderer='numpy', nr_prefetch=4, 
+				 checkpoint=(), encoding='none', encoding_depth=32, input_dtype='float32', 
+				 min_resolution=DIMX, patch_size=None, data_format='NHWC', graph_augment=False, 
+				 volume_depth=0, volume_alpha=0.0, lut_input=False, projection_input=False):
+		assert renderer in ['numpy', 'vtk']
+		assert stride == scale, 'The decoder has to undo the encoder downsampling'
+		self.kernel_shape   = kernel_shape
+		self.stride         = stride
+		self.scale          = scale
+		self.renderer       = renderer
+		self.nr_prefetch    = nr_prefetch
+		self.checkpoint     = tuple(checkpoint)
+		self.encoding       = encoding
+		self.encoding_depth = encoding_depth
+		self.input_dtype    = input_dtype
+		self.min_resolution = min_resolution
+		self.patch_size     = patch_size
+		self.data_format    = data_format
+		self.graph_augment  = graph_augment
+		self.volume_depth   = volume_depth
+		self.volume_alpha   = volume_alpha
+		self.lut_input      = lut_input
+		self.projection_input = projection_input
+
+	def replace(self, **kwargs):
+		config = copy.copy(self)
+		for key, value in six.iteritems(kwargs):
+			assert hasattr(config, key), key
+			setattr(config, key, value)
+		config.checkpoint = tuple(config.checkpoint)
+		return config
+
+	def __repr__(self):
+		return 'GeneratorConfig({})'.format(', '.join('{}={!r}'.format(k, v) for k, v in sorted(six.iteritems(vars(self)))))
+
+GENERATOR_PRESETS = {}
+
+def register_preset(name, config):
+	assert name not in GENERATOR_PRESETS, name
+	GENERATOR_PRESETS[name] = config
+	return config
+
+def get_preset(name):
+	return GENERATOR_PRESETS[name]
+
+register_preset('default', GeneratorConfig(kernel_shape=3, stride=2, scale=2, renderer='numpy', nr_prefetch=4))
+register_preset('1d',      GeneratorConfig(kernel_shape=1, stride=1, scale=1, renderer='vtk',   nr_prefetch=4))
+register_preset('2d',      GeneratorConfig(kernel_shape=3, stride=1, scale=1, renderer='vtk',   nr_prefetch=2))
+register_preset('3d',      GeneratorConfig(kernel_shape=3, stride=2, scale=2, renderer='vtk',   nr_prefetch=2))
+
 ####################################################################################################
 class ImageDataFlow(RNGDataFlow):
-	def __init__(self, image_path, style_path, size, alpha_path=None, dtype='float32', isTrain=False, isValid=False):
+	def __init__(self, image_path, style_path, size, alpha_path=None, dtype='float32', renderer='numpy', 
+				 schedule=None, patch_size=None, io_workers=4, io_depth=4, seed=2015, elastic=None, 
+				 graph_augment=False, pyramid=None, projection=('over',), sample_step=1, shading=False, 
+				 luts_per_sample=1, color_tf=None, fixed_point=False, sparse=0.0, brick_cache=0, cache_dir=None, 
+				 isTrain=False, isValid=False):
 		self.dtype      	= dtype
+		self.renderer   	= renderer
+		self.schedule   	= schedule
+		self.patch_size 	= patch_size
+		self.io_workers 	= io_workers
+		self.io_depth   	= io_depth
+		self.reader     	= None
+		self.seed       	= seed
+		self.params     	= collections.deque(maxlen=1024) # Parameters of the last samples
+		self.elastic_mode	= elastic # None, '2d' (same warp for every slice) or '3d'
+		self.elastic    	= ElasticWarp()
+		self.graph_augment	= graph_augment # Rotation and compositing are left to GraphCompositor
 		self.image_path   	= image_path
 		self.style_path   	= style_path
 		self.alpha_path   	= alpha_path
+		self.luts       	= LUTBank(alpha_path) if alpha_path else None
+		self.pyramid    	= pyramid # None, or 'box' / 'max' to read the volume pyramids
+		self.projection 	= tuple(projection) # Modes of the ground-truth projection, one drawn per sample
+		self.projection_input	= len(self.projection) > 1 # The generator is told which one, see projection_code
+		self.sample_step	= sample_step # Slices per sample along the rays, see PreIntegration
+		self.shader     	= Shader() if shading else None # Blinn-Phong lighting of the ground truth
+		self.luts_per_sample	= luts_per_sample if self.luts is not None else 1
+		self.rgba_points, self.rgba_lut = parse_rgba_transfer_function(color_tf) if color_tf else (None, None)
+		self.fixed_point	= fixed_point # Integer over operator on uint8 slices, see VolumeCompositor.over_fixed
+		self.sparse     	= sparse # Largest fraction of occupied bricks rotated and composited sparsely, see SparseVolume
+		# Compressed bricks of the volumes, created here so the prefetch workers fork with it
+		self.cache      	= BrickCache(brick_cache << 20) if brick_cache and isTrain else None
+		# Shapes and content boxes of the training volumes, computed by the readers the first time a 
+		# volume is read. The index and the pyramids go to cache_dir (the data directory by default)
+		self.cache_dir  	= cache_dir
+		self.index      	= VolumeIndex(image_path, cache_dir) if isTrain and os.path.isdir(image_path) else None
 		self._size      	= size
 		self.isTrain    	= isTrain
 		self.isValid    	= isValid
@@ -56,156 +179,124 @@ class ImageDataFlow(RNGDataFlow):
 		return self._size
 
 	def reset_state(self):
-		self.rng = get_rng(self)
+		# Sample j of worker w out of n is the global sample j*n + w, every sample draws from
+		# its own counter-based stream, so the draws do not depend on the process layout
+		self.worker, self.nr_workers = get_worker_info() or (0, 1)
+		self.counter = 0
+		self.rng = sample_rng(self.seed, self.worker, stream=1) # Draws outside of get_data
+
+	def next_sample(self):
+		index = self.counter * self.nr_workers + self.worker
+		self.counter += 1
+		return index, sample_rng(self.seed, index)
+
+	def get_reader(self):
+		# One reader per process, its loop thread does not survive the fork of the prefetch workers
+		if self.reader is None or self.reader_pid != os.getpid():
+			self.reader = AsyncReader(skimage.io.imread, concurrency=self.io_workers)
+			self.reader_pid = os.getpid()
+		return self.reader
 
 	def get_data(self, shuffle=True):
 		#
 		# Read and store into pairs of images and labels
 		#
-		images = glob.glob(self.image_path + '/*.*')
-		styles = glob.glob(self.style_path + '/*.*')
+		images = list_files(self.image_path)
+		styles = list_files(self.style_path)
 
 		if self._size==None:
 			self._size = len(images)
 
-		from natsort import natsorted
-		images = natsorted(images)
-		styles = natsorted(styles)
-
 		# print(images)
 		# print(styles)
 
+		#
+		# Pick the tuples io_depth samples ahead and start reading them
+		#
+		reader = self.get_reader()
+		planned = collections.deque()
+		def plan():
+			index, rng = self.next_sample()
+			rand_image = int(rng.integers(0, len(images)))
+			rand_style = int(rng.integers(0, len(styles)))
+			params = {'seed': self.seed, 'index': index, 
+					  'image': os.path.basename(images[rand_image]), 
+					  'style': os.path.basename(styles[rand_style])}
+			if self.luts is not None and self.luts_per_sample > 1:
+				params['lut'] = [self.luts.sample(rng)[0] for _ in range(self.luts_per_sample)]
+			elif self.luts is not None:
+				params['lut'], _ = self.luts.sample(rng)
+			read_image = None
+			if self.isTrain:
+				# Volumes larger than DIMZ x DIMY x DIMX are cropped while they are read, 
+				# from their own stream so the other draws do not depend on the volume size
+				crop = sample_rng(self.seed, index, stream=2).uniform(size=3)
+				params['crop'] = [float(u) for u in crop]
+				params['factor'] = DIMX // self.schedule.resolution() if self.schedule else 1
+				level = int(np.log2(params['factor'])) if self.pyramid else 0
+				if level and 2**level == params['factor']:
+					# Low-resolution stages read the matching level of the pyramid
+					params['level'] = level
+					read_image = functools.partial(read_level, level=level, mode=self.pyramid, crop=crop, 
+												   shape=(DIMZ >> level, DIMY >> level, DIMX >> level), cache_dir=self.cache_dir)
+				elif self.cache is not None:
+					read_image = functools.partial(read_cached, shape=(DIMZ, DIMY, DIMX), crop=crop, cache=self.cache)
+				else:
+					read_image = functools.partial(read_volume, shape=(DIMZ, DIMY, DIMX), crop=crop)
+				if self.index is not None:
+					read_image = functools.partial(read_indexed, self.index, read_image)
+			planned.append((rng, params, 
+							reader.submit(images[rand_image], read_image), 
+							reader.submit(styles[rand_style])))
+		# Every training sample is rendered under luts_per_sample transfer functions
+		nr_samples = -(-self._size // self.luts_per_sample) if self.isTrain else self._size
+		produced = 0
+		for k in range(min(self.io_depth, nr_samples)):
+			plan()
+
 		#
 		# Pick the image over size 
 		#
-		for k in range(self._size):
+		for k in range(nr_samples):
 			#
 			# Pick randomly a tuple of training instance
 			#
-			rand_image = np.random.randint(0, len(images))
-			rand_style = np.random.randint(0, len(styles))
+			rng, params, next_image, next_style = planned.popleft()
+			if k + len(planned) + 1 < nr_samples:
+				plan()
+			self.params.append(params)
+			lut = self.luts[params['lut']] if self.luts is not None else default_lut(self.renderer)
+			if self.rgba_lut is not None:
+				lut = self.rgba_lut[:, 3] * 255.0 # The network sees the opacity of the color transfer function
+			# float32 alphas, a float64 lut would double the [K y x z] alphas and the network input
+			lut = np.asarray(lut, dtype=np.float32)
 
 			if self.isTrain:
-								# Read the 3D image
-				image = skimage.io.imread(images[rand_image])
-				if image.shape != [DIMZ, DIMY, DIMX]: # Pad the image
-					dimz, dimy, dimx = image.shape
-					patz, paty, patx = (DIMZ-dimz)/2, (DIMY-dimy)/2, (DIMX-dimx)/2
-					patz, paty, patx = int(patz), int(paty), int(patx)
-					image = np.pad(image, ((patz, patz), (paty, paty), (patx, patx)), 
-								   mode='constant', 
-								   constant_values=0, 
-						)
-				# Make dimz is the last channel
-				image = np.transpose(image.copy(), [1, 2, 0])
-
-				# Rotate and resample volume using the plane of first two axes
-				import scipy.ndimage.interpolation
-				degrees = np.random.uniform(low=0.0, high=360.0)
-				image = scipy.ndimage.interpolation.rotate(image.copy().astype(np.float32), 
-					angle=degrees, 
-					axes=(1, 2), # Rotate along x and z
-					reshape=False, #If reshape is true, the output shape is adapted so that the input 
-								   #array is contained completely in the output. Default is True
-					order=3, 
-					mode='constant')
-				# print(image)
-				image = np.clip(image, 0.0, 255.0) 
-				# image = image.astype(np.uint8)
-
-				# print(image.max())
-				# print(image.min())
-				#
-				# If not specify alpha value
-				# Generate random alpha value
-				#
-				if self.alpha_path==None: 
-					# Generate random alpha value
-					# lut = np.random.uniform(low=0, high=256, size=256).astype(np.uint8)
-					lut = np.linspace(start=0, stop=256, num=256, endpoint=False).astype(np.uint8)
-					# lut = 255.0 - np.linspace(start=0, stop=256, num=256, endpoint=False).astype(np.uint8)
-					lut = 128.0 - np.linspace(start=0, stop=128, num=256, endpoint=False).astype(np.uint8)
-					# lut = 128.0 * np.ones_like(lut)
-					# lut = 8.0 * np.ones_like(lut)
-					for s in range(1):
-						lut[s] = 0.0
-					# lut[1] = 0.0
-					# lut[2] = 0.0
-					# lut[3] = 0.0
-					# lut[lut<32.0] = 0.0
-					# lut[lut>0.0]  = 16.0
-
-					# lut[0] = 0.1
-					# lut[1] = 0.6
-					# ..
-					# lut[255] = 0.2
-				else:
-					pass
-
-				##### Doing projection
-				# Compositing algorithm formula is from slide 23 of
-				# http://www.seas.upenn.edu/~cis565/LECTURES/VolumeRendering.pdf
-				color_s = image.copy() 					# Construct the per-voxel color (or resample _s)
-				alpha_s = lut[color_s.astype(np.uint8)]	# Construct the per-voxel alpha (or resample _s)
-
-				color = np.zeros((DIMY, DIMX), dtype=np.float32)
-				alpha = np.zeros((DIMY, DIMX), dtype=np.float32)
-
-				
-				isBackToFront = True 
-
-				if isBackToFront:		
-					# Over operator, back to front order
-					# Co[z] = Cs[z] + (1 - As[z]*Co[z+1]
-					# Ao[z] = As[z] + (1 - As[z]*Ao[z+1]
-					for z in range(255, -1, -1):
-						color = color_s[...,z]/255.0 + (1-alpha_s[...,z]/255.0) * color
-						alpha = alpha_s[...,z]/255.0 + (1-alpha_s[...,z]/255.0) * alpha
+				# Read the 3D image
+				image = reader.result(next_image)
+				factor = params['factor']
+				box = self.content_box(image.shape, params)
+				image, offset, box = self.prepare_volume(image, factor, rng, params, box)
+				frame = (DIMZ // factor, DIMY // factor, DIMX // factor)
+				if self.graph_augment:
+					# Rotation, transfer function and compositing run in the graph, see GraphCompositor
+					degrees = float(rng.uniform(low=0.0, high=360.0))
+					params['angle'] = degrees
+					image = place(image, offset, tuple(slice(0, n) for n in frame)) # The graph takes whole frames
+					image = np.transpose(image, [1, 2, 0])
+					if self.elastic_mode == '2d':
+						image = self.elastic.warp(image, rng)
+					image = np.expand_dims(np.rint(image).astype(np.uint8), axis=0) # Raw [b y x z]
+					angle = np.array([degrees], dtype=np.float32)
 				else:
-					# Under operator, front to back order
-					# Co[z] = Co[z-1] + (1 - Ao[z-1])*Cs[z]
-					# Ao[z] = Ao[z-1] + (1 - Ao[z-1])*As[z]
-					for z in range(0, 256, 1):
-						color = color + (1-alpha) * color_s[...,z]/255.0
-						alpha = alpha + (1-alpha) * alpha_s[...,z]/255.0
-
-				# Create the img2d image
-				img2d = np.zeros((DIMY, DIMX, 3), dtype=np.float32)
-				color = skimage.color.gray2rgb(color*255.0)
-				img2d = color.copy()
-				img2d = np.clip(img2d, 0.0, 255.0) 
-				# img2d = color.astype(np.uint8)
-				# img2d[...,3:4] = (alpha*255.0).astype(np.uint8)
-				# img2d[...,0] = 255.0*color
-				# img2d[...,1] = 255.0*color
-				# img2d[...,2] = 255.0*color
-
-				# Expand the volume to 4D
-				image = np.expand_dims(image, axis=-0) # Expand to make bxyz
-				alpha_s = np.expand_dims(alpha_s, axis=0)
-				image = np.concatenate((image, alpha_s), axis=-1) # Concatenate the volume [b y x (z+c)]
-				img2d = np.expand_dims(img2d, axis=0)
+					image, img2d = self.project(image, lut, rng, params, frame, offset, box)
 
 				# Read the style
-				style = skimage.io.imread(styles[rand_style])
-				if style.ndim == 2: # If gray image, convert to 3 channel
-					style = skimage.color.gray2rgb(style)
-					# style = cv2.cvtColor(style, cv2.GRAY2RGB)
-				seeds = np.random.randint(0, 20152015)
-				style = self.random_flip(style, seed=seeds)        
-				style = self.random_reverse(style, seed=seeds)
-				style = self.random_square_rotate(style, seed=seeds)           
-				style = np.expand_dims(style, axis=0)
-				style = style[...,0:3]
-				# TODO: Random augment the style
-				# Resize if necessary 
-				# style = skimage.transform.resize
-
-				
+				style = self.prepare_style(reader.result(next_style), factor, rng, params)
 
 			else:
 				# Read the 3D image
-				image = skimage.io.imread(images[rand_image])
+				image = reader.result(next_image)
 				# if image.shape != [DIMZ, DIMY, DIMX]: # Pad the image
 				# 	dimz, dimy, dimx = image.shape
 				# 	patz, paty, patx = (DIMZ-dimz)/2, (DIMY-dimy)/2, (DIMX-dimx)/2
@@ -219,22 +310,20 @@ class ImageDataFlow(RNGDataFlow):
 				if image.ndim == 2: # If gray image, convert to 3 channel
 					image = skimage.color.gray2rgb(image)
 					# image = cv2.cvtColor(image, cv2.GRAY2RGB)
-				seedi = np.random.randint(0, 20152015)
-				# image = self.random_flip(image, seed=seedi)        
-				# image = self.random_reverse(image, seed=seedi)
-				# image = self.random_square_rotate(image, seed=seedi)           
+				# image = self.random_flip(image)        
+				# image = self.random_reverse(image)
+				# image = self.random_square_rotate(image)           
 				image = np.expand_dims(image, axis=0)
 				image = image[...,0:3]
 
 				# Read the style
-				style = skimage.io.imread(styles[rand_style])
+				style = reader.result(next_style)
 				if style.ndim == 2: # If gray image, convert to 3 channel
 					style = skimage.color.gray2rgb(style)
 					# style = cv2.cvtColor(style, cv2.GRAY2RGB)
-				seeds = np.random.randint(0, 20152015)
-				# style = self.random_flip(style, seed=seeds)        
-				# style = self.random_reverse(style, seed=seeds)
-				# style = self.random_square_rotate(style, seed=seeds)           
+				# style = self.random_flip(style)        
+				# style = self.random_reverse(style)
+				# style = self.random_square_rotate(style)           
 				style = np.expand_dims(style, axis=0)
 				style = style[...,0:3]
 				# print(style.shape)
@@ -245,7 +334,7 @@ class ImageDataFlow(RNGDataFlow):
 
 				# # Rotate and resample volume
 				# import scipy.ndimage.interpolation
-				# degrees = np.random.uniform(low=0.0, high=360.0)
+				# degrees = rng.uniform(low=0.0, high=360.0)
 
 				# image = scipy.ndimage.interpolation.rotate(image, 
 				# 	angle=degrees, 
@@ -255,102 +344,324 @@ class ImageDataFlow(RNGDataFlow):
 				# 	order=3, 
 				# 	mode='reflect')
 
-			yield [image.astype(np.float32), 
+			# The transfer function is only an input when it changes from sample to sample, and so
+			# is the projection mode
+			extra = [lut.astype(np.float32)] if self.luts is not None else []
+			code = [projection_code(params.get('projection', self.projection[0]))] if self.projection_input else []
+			extra = extra + code
+			if self.isTrain and self.graph_augment:
+				yield [image, style.astype(np.float32), angle] + extra
+				continue
+			if self.dtype == 'uint8':
+				image = np.rint(image) # Resampled intensities are floats, round instead of truncating
+			if lut.ndim == 2:
+				# One datapoint per transfer function, all from the same pass over the volume
+				for j in range(min(len(lut), self._size - produced)):
+					yield [image[j:j+1].astype(self.dtype), 
+						   style.astype(np.float32), 
+						   img2d[j:j+1].astype(np.float32), 
+						   lut[j].astype(np.float32), 
+						   ] + code
+				produced += len(lut)
+				continue
+			yield [image.astype(self.dtype), 
 				   style.astype(np.float32), 
 				   img2d.astype(np.float32), 
-				   ]
-
-	def random_flip(self, image, seed=None):
-		assert ((image.ndim == 2) | (image.ndim == 3))
-		if seed:
-			np.random.seed(seed)
-		random_flip = np.random.randint(1,5)
-		if random_flip==1:
-			flipped = image[...,::1,::-1,:]
-			image = flipped
-		elif random_flip==2:
-			flipped = image[...,::-1,::1,:]
-			image = flipped
-		elif random_flip==3:
-			flipped = image[...,::-1,::-1,:]
-			image = flipped
-		elif random_flip==4:
-			flipped = image
-			image = flipped
-		return image
+				   ] + extra
+
+		logger.info('Reader queue: {}'.format(reader.stats()))
+
+	def content_box(self, shape, params):
+		# Box [(lo, hi)] of the non-zero voxels of the volume [z y x] of shape read for params, 
+		# from the index of the dataset, None when the volume is not in it
+		entry = self.index.entries.get(params['image']) if self.index is not None else None
+		if entry is None:
+			return None
+		level = params.get('level', 0)
+		box = []
+		for (lo, hi), n, size, d, u in zip(entry['box'], entry['shape'], (DIMZ, DIMY, DIMX), shape, params['crop']):
+			for _ in range(level): # The levels of the pyramid halve the sides, rounding up
+				n, lo, hi = -(-n // 2), lo // 2, -(-hi // 2)
+			start = window_start(n, size >> level, u)
+			box.append((min(max(lo - start, 0), d), min(max(hi - start, 0), d)))
+		return box if all(lo < hi for lo, hi in box) else [(0, 0)] * 3
+
+	def prepare_volume(self, image, factor, rng, params, box=None):
+		# Downsample and deform the volume [z y x], read at params['level'] of its pyramid. 
+		# It sits centered in the frame of DIMZ/factor x DIMY/factor x DIMX/factor voxels, odd 
+		# differences get the extra voxel at the end, but it is only padded to whole blocks of the 
+		# downsampling (to the frame under the 3d warp). Returns the volume, its offset in the 
+		# frame and the content box moved along (None when unknown)
+		level = params.get('level', 0)
+		step = factor >> level
+		target = (DIMZ >> level, DIMY >> level, DIMX >> level)
+		pad, offset = [], []
+		for n, d in zip(target, image.shape):
+			before = (n - d) // 2
+			lo, hi = (0, n) if self.elastic_mode == '3d' else (before // step * step, -(-(before + d) // step) * step)
+			pad.append((before - lo, hi - before - d))
+			offset.append(lo // step)
+		if any(a or b for a, b in pad):
+			image = np.pad(image, pad, mode='constant', constant_values=0)
+		if box is not None:
+			box = [((l + a) // step, -(-(h + a) // step)) if l < h else (0, 0) for (l, h), (a, _) in zip(box, pad)]
+		# Downsample to the resolution of the current training stage
+		image = downsample_volume(image, step)
+		if self.elastic_mode == '3d':
+			image = self.elastic.warp_volume(image, rng)
+			box = None # Moved by the warp
+		return image, tuple(offset), box
+
+	def project(self, image, lut, rng, params, frame=None, offset=(0, 0, 0), box=None):
+		# Rotate the volume, apply the transfer function and composite it
+		# Returns the network input [b y x (z+c)] and the projection [b y x 3], with b the 
+		# number of transfer functions in lut ([256] or a stack [K, 256]), all done in one pass
+		# image [z y x] sits at offset in a frame of zeros of shape frame (its own by default), 
+		# box is its content box, only the rotation window of the content is padded and rotated
+		# Make dimz is the last channel
+		image = np.transpose(image, [1, 2, 0])
+		frame = (frame[1], frame[2], frame[0]) if frame else image.shape
+		offset = (offset[1], offset[2], offset[0])
+		box = [box[1], box[2], box[0]] if box else None
+		if self.elastic_mode == '2d':
+			# The warp is scaled to the frame, all the slices in one remap
+			image = self.elastic.warp(place(image, offset, tuple(slice(0, n) for n in frame)), rng)
+			offset, box = (0, 0, 0), None
+
+		# Pick the patch, rows are cropped now since the rotation below keeps them apart, 
+		# columns once they are rotated. Compositing runs along z, so the projection of 
+		# the cropped columns is the crop of the projection.
+		if self.patch_size:
+			patch = min(self.patch_size, frame[0], frame[1])
+			y0 = int(rng.integers(0, frame[0] - patch + 1))
+			x0 = int(rng.integers(0, frame[1] - patch + 1))
+			params['patch'] = (y0, x0, patch)
+			rows = slice(min(max(y0 - offset[0], 0), image.shape[0]), min(max(y0 + patch - offset[0], 0), image.shape[0]))
+			image = image[rows]
+			offset = (max(offset[0] - y0, 0),) + offset[1:]
+			frame = (patch,) + frame[1:]
+			if box:
+				box[0] = (min(max(box[0][0] - rows.start, 0), image.shape[0]), min(max(box[0][1] - rows.start, 0), image.shape[0]))
+
+		# Rotate and resample volume using the plane of first two axes, only around the 
+		# non-zero voxels when empty space is transparent (see VolumeCompositor)
+		degrees = float(rng.uniform(low=0.0, high=360.0))
+		params['angle'] = degrees
+		mode = self.projection[0]
+		if len(self.projection) > 1: # Only draw when there is a choice, the default streams stay put
+			mode = self.projection[int(rng.integers(0, len(self.projection)))]
+		params['projection'] = mode
+		# Zeros never change the intensity projections, nor the over operator if they are transparent
+		luts = np.atleast_2d(lut)
+		if transparent_zero(luts) or mode != 'over':
+			box = box or bounding_box(image) # Scans the volume without the padding
+			box = [(lo + o, hi + o) if lo < hi else (0, 0) for (lo, hi), o in zip(box, offset)] # In the frame
+		else:
+			box = None
+		sparse = None
+		if self.sparse and mode == 'over' and transparent_zero(luts):
+			# Bricks of the content box, stays dense above the occupancy
+			sparse = sparse_volume(image, max_occupancy=self.sparse, shape=frame, offset=offset, box=box)
+		if isinstance(sparse, SparseVolume):
+			sparse = sparse.rotate(degrees, order=3)
+			# The network input is dense, only the patch columns are assembled from the bricks
+			cols = (x0, x0 + patch) if self.patch_size else (0, frame[1])
+			image = sparse.read((0, cols[0], 0), (frame[0], cols[1], frame[2]))
+			window = tuple(slice(0, n) for n in frame)
+		else:
+			sparse = None
+			image, window = rotate_content(image, degrees, box, order=3, shape=frame, offset=offset)
+		ys, xs, zs = window
+		columns = slice(None)
+		if self.patch_size:
+			columns = slice(x0, x0+patch)
+			if sparse is None: # Already the patch columns
+				image = image[:, x0:x0+patch]
+			xs = slice(min(max(xs.start - x0, 0), patch), min(max(xs.stop - x0, 0), patch))
+
+		# print(image.max())
+		# print(image.min())
+		##### Doing projection
+		# Compositing algorithm formula is from slide 23 of
+		# http://www.seas.upenn.edu/~cis565/LECTURES/VolumeRendering.pdf
+		color_s = image.copy() 					# Construct the per-voxel color (or resample _s)
+		alpha_s = apply_lut(luts, color_s)		# Construct the per-voxel alpha [K y x z] (or resample _s)
+		if self.shader is not None and mode == 'over' and self.renderer == 'numpy':
+			# Light the colors, the alphas still come from the intensities
+			color_s[ys, xs, zs] = self.shader.shade(image, (ys, xs, zs))
+
+		dimy, dimx, dimz = image.shape
+		color = np.zeros((len(luts), dimy, dimx), dtype=np.float32)
+		alpha = np.zeros((len(luts), dimy, dimx), dtype=np.float32)
 
-	def random_reverse(self, image, seed=None):
-		assert ((image.ndim == 2) | (image.ndim == 3))
-		if seed:
-			np.random.seed(seed)
-		random_reverse = np.random.randint(1,3)
-		if random_reverse==1:
-			reverse = image[::1,...]
-		elif random_reverse==2:
-			reverse = image[::-1,...]
-		image = reverse
-		return image
+		
+		isBackToFront = True 
+
+		if self.renderer=='vtk':
+			from VolumeSampler import VolumeRender, VolumeRenderToImage
+			assert len(luts) == 1, 'The vtk renderer has its own transfer function'
+			alpha_s = alpha_s.astype(np.uint8)
+			tf=[[0,0,0,0,0.0],[255, 1,1,1,1]] if self.rgba_points is None else self.rgba_points.tolist()
+			# Ray cast the content window only, placed where it is in the volume
+			content = image[ys, xs, zs]
+			origin = [zs.start, xs.start, ys.start] # vtk x, y, z are the last, middle and first axes
+			actor_list = VolumeRender(content, tf=tf, origin=origin, blend=mode, sample_step=self.sample_step, 
+									  shade=self.shader is not None) if content.size else []
+			color = VolumeRenderToImage(actor_list)
+		elif self.rgba_lut is not None and mode == 'over':
+			# Premultiplied RGBA straight into the 3 channel output, padded around the window
+			img2d = np.zeros((1, dimy, dimx, 3), dtype=np.float32)
+			over_rgba(color_s[ys, xs, zs], self.rgba_lut, out=img2d[0, ys, xs])
+		elif mode != 'over':
+			# One reduction along the rays, the ray length is the whole depth
+			color[:, ys, xs] = project_intensity(color_s[ys, xs, zs], mode, depth=dimz)
+		elif self.sample_step > 1:
+			# One pre-integrated segment every sample_step slices, the K tables in one pass
+			color[:, ys, xs], alpha[:, ys, xs] = composite_preintegrated(color_s[ys, xs, zs], get_table(luts, self.sample_step), self.sample_step)
+		elif sparse is not None:
+			# Front to back over the occupied bricks of the whole rows, then the patch columns
+			c, a = sparse.composite(luts)
+			color[:], alpha[:] = c[..., columns], a[..., columns]
+		elif self.fixed_point:
+			# Integer over operator, the alphas come from the intensities like apply_lut does, the
+			# colors from color_s which may be shaded
+			intensities = np.clip(np.rint(image[ys, xs, zs]), 0, 255).astype(np.uint8)
+			alphas = apply_lut(np.rint(luts).astype(np.uint8), intensities)
+			colors = np.clip(np.rint(color_s[ys, xs, zs]), 0, 255).astype(np.uint8)
+			color[:, ys, xs], alpha[:, ys, xs] = over_fixed(colors, alphas)
+		elif isBackToFront:		
+			# Over operator, back to front order, the projection is padded around the window
+			color[:, ys, xs], alpha[:, ys, xs] = over(color_s[ys, xs, zs], alpha_s[:, ys, xs, zs])
+		else:
+			# Under operator, front to back order
+			# Co[z] = Co[z-1] + (1 - Ao[z-1])*Cs[z]
+			# Ao[z] = Ao[z-1] + (1 - Ao[z-1])*As[z]
+			for z in range(0, dimz, 1):
+				color = color + (1-alpha) * color_s[...,z]/255.0
+				alpha = alpha + (1-alpha) * alpha_s[...,z]/255.0
+
+		# Create the img2d image [b y x 3]
+		if self.renderer=='vtk':
+			img2d = np.clip(np.expand_dims(color.astype(np.float32), axis=0), 0.0, 255.0)
+		elif self.rgba_lut is not None and mode == 'over':
+			img2d = np.clip(np.multiply(img2d, 255.0, out=img2d), 0.0, 255.0, out=img2d)
+		else:
+			# Gray, the channels are a view of the one composited image
+			img2d = gray_to_rgb(np.clip(color * 255.0, 0.0, 255.0))
+		# img2d = color.astype(np.uint8)
+		# img2d[...,3:4] = (alpha*255.0).astype(np.uint8)
+		# img2d[...,0] = 255.0*color
+		# img2d[...,1] = 255.0*color
+		# img2d[...,2] = 255.0*color
+
+		# Expand the volume to 4D, one copy per transfer function
+		image = np.broadcast_to(image, alpha_s.shape) # Expand to make bxyz
+		image = np.concatenate((image, alpha_s), axis=-1) # Concatenate the volume [b y x (z+c)]
+		return image, img2d
+
+	def prepare_style(self, style, factor, rng, params):
+		# Augment, resize and crop the style like the volume, returns [b y x 3]
+		if style.ndim == 2: # If gray image, convert to 3 channel
+			style = skimage.color.gray2rgb(style)
+			# style = cv2.cvtColor(style, cv2.GRAY2RGB)
+		params['flip']    = int(rng.integers(1, 5))
+		params['reverse'] = int(rng.integers(1, 3))
+		params['rotate']  = int(rng.integers(0, 4))
+		# Flip, reverse and rotate as one strided view
+		style = apply_dihedral(style, dihedral(params['flip'], params['reverse'], params['rotate']))
+		if factor > 1:
+			style = cv2.resize(np.ascontiguousarray(style), (style.shape[1] // factor, style.shape[0] // factor), interpolation=cv2.INTER_AREA)
+		if 'patch' in params:
+			y0, x0, patch = params['patch']
+			style = style[y0:y0+patch, x0:x0+patch]
+		style = np.expand_dims(style, axis=0)
+		style = style[...,0:3]
+		# TODO: Random augment the style
+		# Resize if necessary 
+		# style = skimage.transform.resize
+		return style
+
+####################################################################################################
+def sample_rng(seed, index, stream=0):
+	# Philox is counter-based: the high counter words pick a stream of 2^128 draws, disjoint
+	# for every (index, stream), and the draws of a sample only depend on (seed, index)
+	return np.random.Generator(np.random.Philox(key=seed, counter=[0, 0, index, stream]))
+
+def projection_code(mode):
+	# One-hot projection mode [1, len(PROJECTION_MODES)], the generator input telling the modes apart
+	code = np.zeros((1, len(PROJECTION_MODES)), dtype=np.float32)
+	code[0, PROJECTION_MODES.index(mode)] = 1.0
+	return code
+
+def read_indexed(index, read, path):
+	# read(path), with the entry of the volume in the VolumeIndex index computed the first time
+	index.entry(path)
+	return read(path)
 
-	def random_square_rotate(self, image, seed=None):
-		assert ((image.ndim == 2) | (image.ndim == 3))
-		if seed:
-			np.random.seed(seed)        
-		random_rotatedeg = 90*np.random.randint(0,4)
-		rotated = image.copy()
-		from scipy.ndimage.interpolation import rotate
-		if image.ndim==2:
-			rotated = rotate(image, random_rotatedeg, axes=(0,1))
-		elif image.ndim==3:
-			rotated = rotate(image, random_rotatedeg, axes=(0,1)) # Channel
-		image = rotated
+####################################################################################################
+def default_lut(renderer='numpy'):
+	# Transfer function, maps the voxel intensity to its alpha in [0, 255]
+	if renderer=='vtk':
+		# The vtk renderer has its own transfer function, alpha is only fed to the network
+		return np.linspace(start=0, stop=256, num=256, endpoint=False).astype(np.uint8)
+	# lut = np.random.uniform(low=0, high=256, size=256).astype(np.uint8)
+	# lut = 255.0 - np.linspace(start=0, stop=256, num=256, endpoint=False).astype(np.uint8)
+	lut = 128.0 - np.linspace(start=0, stop=128, num=256, endpoint=False).astype(np.uint8)
+	# lut = 128.0 * np.ones_like(lut)
+	# lut = 8.0 * np.ones_like(lut)
+	lut[0] = 0.0 # Empty space is transparent
+	# lut[lut<32.0] = 0.0
+	# lut[lut>0.0]  = 16.0
+	return lut.astype(np.float32)
+
+####################################################################################################
+def downsample_volume(image, factor):
+	# Box filter over factor^3 blocks, the volume sides have to be multiples of factor
+	if factor == 1:
 		return image
-				
-	def random_elastic(self, image, seed=None):
-		assert ((image.ndim == 2) | (image.ndim == 3))
-		old_shape = image.shape
-
-		if image.ndim==2:
-			image = np.expand_dims(image, axis=0) # Make 3D
-		new_shape = image.shape
-		dimx, dimy = new_shape[1], new_shape[2]
-		size = np.random.randint(4,16) #4,32
-		ampl = np.random.randint(2, 5) #4,8
-		du = np.random.uniform(-ampl, ampl, size=(size, size)).astype(np.float32)
-		dv = np.random.uniform(-ampl, ampl, size=(size, size)).astype(np.float32)
-		# Done distort at boundary
-		du[ 0,:] = 0
-		du[-1,:] = 0
-		du[:, 0] = 0
-		du[:,-1] = 0
-		dv[ 0,:] = 0
-		dv[-1,:] = 0
-		dv[:, 0] = 0
-		dv[:,-1] = 0
-		import cv2
-		from scipy.ndimage.interpolation    import map_coordinates
-		# Interpolate du
-		DU = cv2.resize(du, (new_shape[1], new_shape[2])) 
-		DV = cv2.resize(dv, (new_shape[1], new_shape[2])) 
-		X, Y = np.meshgrid(np.arange(new_shape[1]), np.arange(new_shape[2]))
-		indices = np.reshape(Y+DV, (-1, 1)), np.reshape(X+DU, (-1, 1))
-		
-		warped = image.copy()
-		for z in range(new_shape[0]): #Loop over the channel
-			# print z
-			imageZ = np.squeeze(image[z,...])
-			flowZ  = map_coordinates(imageZ, indices, order=0).astype(np.float32)
+	dimz, dimy, dimx = image.shape
+	assert dimz % factor == 0 and dimy % factor == 0 and dimx % factor == 0
+	blocks = image.reshape(dimz // factor, factor, dimy // factor, factor, dimx // factor, factor)
+	return blocks.mean(axis=(1, 3, 5), dtype=np.float32)
 
-			warpedZ = flowZ.reshape(image[z,...].shape)
-			warped[z,...] = warpedZ     
-		warped = np.reshape(warped, old_shape)
-		return warped
+####################################################################################################
+def sample_nbytes(config):
+	# Upper bound of the bytes of one [image, style, img2d] datapoint
+	lut = 256 * 4 + ALIGNMENT if config.lut_input else 0
+	lut += len(PROJECTION_MODES) * 4 + ALIGNMENT if config.projection_input else 0
+	if config.graph_augment: # [volume, style, angle]
+		return DIMY * DIMX * (DIMZ + 3 * 4) + 4 + 3 * ALIGNMENT + lut
+	itemsize = np.dtype(config.input_dtype).itemsize
+	return DIMY * DIMX * (DIMZ * 2 * itemsize + 3 * 4 + 3 * 4) + 3 * ALIGNMENT + lut
 
 ####################################################################################################
-def get_data(image_path, style_path, alpha_path=None, size=EPOCH_SIZE):
+def get_data(image_path, style_path, alpha_path=None, size=EPOCH_SIZE, dtype='float32', renderer='numpy', schedule=None, 
+			 patch_size=None, io_workers=4, io_depth=4, seed=2015, elastic=None, graph_augment=False, pyramid=None, 
+			 projection=('over',), sample_step=1, shading=False, luts_per_sample=1, color_tf=None, fixed_point=False, 
+			 sparse=0.0, brick_cache=0, cache_dir=None):
 	ds_train = ImageDataFlow(image_path=image_path,
 							 style_path=style_path, 
 							 alpha_path=alpha_path, 
 							 size=size, 
+							 dtype=dtype, 
+							 renderer=renderer, 
+							 schedule=schedule, 
+							 patch_size=patch_size, 
+							 io_workers=io_workers, 
+							 io_depth=io_depth, 
+							 seed=seed, 
+							 elastic=elastic, 
+							 graph_augment=graph_augment, 
+							 pyramid=pyramid, 
+							 projection=projection, 
+							 sample_step=sample_step, 
+							 shading=shading, 
+							 luts_per_sample=luts_per_sample, 
+							 color_tf=color_tf, 
+							 fixed_point=fixed_point, 
+							 sparse=sparse, 
+							 brick_cache=brick_cache, 
+							 cache_dir=cache_dir, 
 							 isTrain=True
 							 )
 
@@ -358,6 +669,9 @@ def get_data(image_path, style_path, alpha_path=None, size=EPOCH_SIZE):
 							 style_path=style_path, 
 							 alpha_path=alpha_path, 
 							 size=size, 
+							 dtype=dtype, 
+							 renderer=renderer, 
+							 seed=seed+1, 
 							 isValid=True
 							 )
 
@@ -401,67 +715,199 @@ def np_2imag(x, maxVal = 255.0, name='ToRangeImag'):
 ###############################################################################
 # FusionNet
 @layer_register(log_shape=True)
-def residual(x, chan, first=False):
-	with argscope([Conv2D], nl=INLReLU, stride=1, kernel_shape=3):
-		input = x
-		return (LinearWrap(x)
-				.Conv2D('conv1', chan, padding='SAME', dilation_rate=1)
-				.Conv2D('conv2', chan, padding='SAME', dilation_rate=2)
-				.Conv2D('conv4', chan, padding='SAME', dilation_rate=4)				
-				.Conv2D('conv5', chan, padding='SAME', dilation_rate=8)
-				# .Conv2D('conv1', chan, padding='SAME', dilation_rate=1)
-				# .Conv2D('conv2', chan, padding='SAME', dilation_rate=1)
-				.Conv2D('conv0', chan, padding='SAME', nl=tf.identity)
-				.InstanceNorm('inorm')()) + input
+def residual(x, chan, first=False, checkpoint=False, kernel_shape=3):
+	def block(x):
+		with argscope([Conv2D], nl=INLReLU, stride=1, kernel_shape=kernel_shape):
+			input = x
+			return (LinearWrap(x)
+					.Conv2D('conv1', chan, padding='SAME', dilation_rate=1)
+					.Conv2D('conv2', chan, padding='SAME', dilation_rate=2)
+					.Conv2D('conv4', chan, padding='SAME', dilation_rate=4)				
+					.Conv2D('conv5', chan, padding='SAME', dilation_rate=8)
+					# .Conv2D('conv1', chan, padding='SAME', dilation_rate=1)
+					# .Conv2D('conv2', chan, padding='SAME', dilation_rate=1)
+					.Conv2D('conv0', chan, padding='SAME', nl=tf.identity)
+					.InstanceNorm('inorm')()) + input
+	if checkpoint:
+		return recompute_grad(block, x)
+	return block(x)
+
+###############################################################################
+# Gradient checkpointing
+def recompute_grad(fn, x):
+	"""
+	Apply fn to x, keeping only x and the output alive for the backward pass.
+	The activations inside fn are recomputed when the gradient is requested.
+	fn must be free of state updates (InstanceNorm is, BatchNorm is not) and the
+	enclosing variable scope must use resource variables.
+	"""
+	# tf.contrib calls fn a second time while building the gradient, outside of
+	# any tensorpack argscope, so capture the active one and re-enter it each call
+	scope = [(name, dict(kwargs)) for name, kwargs in six.iteritems(get_arg_scope())]
+	def enter(x, k):
+		# One argscope per layer, nested (contextlib.ExitStack is Python 3 only)
+		if k == len(scope):
+			return fn(x)
+		name, kwargs = scope[k]
+		with argscope(get_registered_layer(name), **kwargs):
+			return enter(x, k + 1)
+	def wrapped(x):
+		return enter(x, 0)
+	return tf.contrib.layers.recompute_grad(wrapped)(x)
+
+# Number of feature maps of the block size kept per layer without checkpointing
+# (conv output, InstanceNorm output and activation)
+TENSORS_PER_CONV = 3
+TENSORS_PER_RESIDUAL = 4*TENSORS_PER_CONV + 3 # conv1..conv5, conv0, inorm, add
+
+def generator_memory_report(config=None, batch=1, dimy=DIMY, dimx=DIMX, dimz=DIMZ, nbytes=4):
+	"""
+	Estimate the activation memory (in bytes) arch_generator keeps for the backward
+	pass, per scale, when the residual blocks of the scales in config.checkpoint are recomputed.
+
+	Returns
+	-------
+	list of (scale name, bytes) and the total in bytes
+	"""
+	config = config or get_preset('default')
+	checkpoint, stride = config.checkpoint, config.stride
+	def fmap(height, width, chan):
+		return batch * height * width * chan * nbytes
+
+	rows = [('input', fmap(dimy, dimx, dimz*2))]
+	enc_chan = [NB_FILTERS*1, NB_FILTERS*2, NB_FILTERS*4, NB_FILTERS*8]
+	dec_chan = [NB_FILTERS*1, NB_FILTERS*1, NB_FILTERS*2, NB_FILTERS*4]
+	for k in range(4):
+		height, width = dimy // stride**(k+1), dimx // stride**(k+1)
+		res_tensors = 1 if k in checkpoint else TENSORS_PER_RESIDUAL
+		# conv_i, residual, conv_o
+		enc = fmap(height, width, enc_chan[k]) * (2*TENSORS_PER_CONV + res_tensors)
+		rows.append(('i%d' % k, enc))
+	for k in range(3, -1, -1):
+		height, width = dimy // stride**(k+1), dimx // stride**(k+1)
+		res_tensors = 1 if k in checkpoint else TENSORS_PER_RESIDUAL
+		# deconv_i, residual, deconv_o (conv with scale**2 channels, then depth_to_space)
+		dec = fmap(height, width, dec_chan[k]) * (TENSORS_PER_CONV + res_tensors + (TENSORS_PER_CONV + 1) * config.scale**2)
+		rows.append(('d%d' % k, dec))
+	rows.append(('dd', fmap(dimy, dimx, 4*config.volume_depth or 3) * 2))
+	return rows, sum(size for _, size in rows)
+
+def print_memory_report(config=None, batch=1, dimy=DIMY, dimx=DIMX, dimz=DIMZ):
+	config = config or get_preset('default')
+	configs = [()] + [(k,) for k in range(4)] + [tuple(range(4))]
+	for checkpoint in configs:
+		rows, total = generator_memory_report(config.replace(checkpoint=checkpoint), 
+			batch=batch, dimy=dimy, dimx=dimx, dimz=dimz)
+		logger.info('Checkpointed scales {}: {:.1f} MB ({})'.format(
+			list(checkpoint), total / 2.0**20, 
+			', '.join('{} {:.1f}'.format(name, size / 2.0**20) for name, size in rows)))
+
+def print_preintegration_report(path, lut, steps=(1, 2, 3, 4)):
+	volume = np.transpose(read_volume(path, shape=(DIMZ, DIMY, DIMX)), [1, 2, 0])
+	for step, seconds, psnr, naive in preintegration_benchmark(volume, lut, steps):
+		logger.info('Sample step {}: {:.3f} s, PSNR {:.1f} dB pre-integrated, {:.1f} dB subsampled'.format(
+			step, seconds, psnr, naive))
+
+def print_fixed_point_report(path, lut):
+	volume = np.transpose(read_volume(path, shape=(DIMZ, DIMY, DIMX)), [1, 2, 0]).astype(np.uint8)
+	alphas = apply_lut(np.rint(lut).astype(np.uint8), volume)
+	start = time.time()
+	over(volume.astype(np.float32), alphas)
+	seconds = time.time() - start
+	start = time.time()
+	over_fixed(volume, alphas)
+	fixed_seconds = time.time() - start
+	color_error, alpha_error, color_bound, alpha_bound = check_fixed(volume, alphas)
+	logger.info('Fixed point: {:.3f} s against {:.3f} s in float'.format(fixed_seconds, seconds))
+	logger.info('Fixed point error: color {:.2e} (bound {:.2e}), alpha {:.2e} (bound {:.2e})'.format(
+		color_error, color_bound, alpha_error, alpha_bound))
+	assert color_error <= color_bound and alpha_error <= alpha_bound, 'The fixed point compositing is off its bound'
+	verify_fixed()
+	logger.info('Fixed point checked on random, opaque and transparent slabs')
+
+def print_sparse_report(path, lut, degrees=30.0):
+	# The volume as it is and with its empty space filled, which occupies every brick
+	volume = np.transpose(read_volume(path, shape=(DIMZ, DIMY, DIMX)), [1, 2, 0]).astype(np.float32)
+	for name, dense in (('Sparse', volume), ('Dense', np.maximum(volume, 1.0))):
+		start = time.time()
+		rotated, window = rotate_content(dense, degrees, bounding_box(dense), order=3)
+		color, _ = over(rotated[window], apply_lut(lut, rotated[window]))
+		seconds = time.time() - start
+		bricks = SparseVolume.from_dense(dense)
+		start = time.time()
+		rotated_bricks = bricks.rotate(degrees, order=3)
+		sparse_color, _ = rotated_bricks.composite(lut)
+		sparse_seconds = time.time() - start
+		start = time.time()
+		rotated_bricks.to_dense()
+		dense_seconds = time.time() - start
+		error = float(np.abs(sparse_color[window[:2]] - color).max()) if color.size else 0.0
+		logger.info('{} volume, {:.1%} of the bricks: {:.3f} s sparse (+{:.3f} s to_dense) against {:.3f} s dense, '
+					'max difference {:.2e}'.format(name, bricks.fraction, sparse_seconds, dense_seconds, seconds, error))
 
 ###############################################################################
 @layer_register(log_shape=True)
-def Subpix2D(inputs, chan, scale=2, stride=1):
-	with argscope([Conv2D], nl=INLReLU, stride=stride, kernel_shape=3):
+def Subpix2D(inputs, chan, scale=2, stride=1, kernel_shape=3, data_format='NHWC'):
+	with argscope([Conv2D], nl=INLReLU, stride=stride, kernel_shape=kernel_shape, data_format=data_format):
 		results = Conv2D('conv0', inputs, chan* scale**2, padding='SAME')
 		old_shape = inputs.get_shape().as_list()
 		# results = tf.reshape(results, [-1, chan, old_shape[2]*scale, old_shape[3]*scale])
 		# results = tf.reshape(results, [-1, old_shape[1]*scale, old_shape[2]*scale, chan])
 		if scale>1:
-			results = tf.depth_to_space(results, scale, name='depth2space', data_format='NHWC')
+			results = tf.depth_to_space(results, scale, name='depth2space', data_format=data_format)
 		return results
 
 ###############################################################################
 @layer_register(log_shape=True)
-def residual_enc(x, chan, first=False):
-	with argscope([Conv2D, Deconv2D], nl=INLReLU, stride=1, kernel_shape=3):
+def residual_enc(x, chan, first=False, checkpoint=False, kernel_shape=3, stride=2):
+	with argscope([Conv2D, Deconv2D], nl=INLReLU, stride=1, kernel_shape=kernel_shape):
 		x = (LinearWrap(x)
 			# .Dropout('drop', 0.75)
-			.Conv2D('conv_i', chan, stride=2) 
-			.residual('res_', chan, first=True)
+			.Conv2D('conv_i', chan, stride=stride) 
+			.residual('res_', chan, first=True, checkpoint=checkpoint, kernel_shape=kernel_shape)
 			.Conv2D('conv_o', chan, stride=1) 
 			())
 		return x
 
 ###############################################################################
 @layer_register(log_shape=True)
-def residual_dec(x, chan, first=False):
-	with argscope([Conv2D, Deconv2D], nl=INLReLU, stride=1, kernel_shape=3):
+def residual_dec(x, chan, first=False, checkpoint=False, kernel_shape=3, scale=2):
+	with argscope([Conv2D, Deconv2D], nl=INLReLU, stride=1, kernel_shape=kernel_shape):
 				
 		x = (LinearWrap(x)
-			.Subpix2D('deconv_i', chan, scale=1) 
-			.residual('res2_', chan, first=True)
-			.Subpix2D('deconv_o', chan, scale=2) 
+			.Subpix2D('deconv_i', chan, scale=1, kernel_shape=kernel_shape) 
+			.residual('res2_', chan, first=True, checkpoint=checkpoint, kernel_shape=kernel_shape)
+			.Subpix2D('deconv_o', chan, scale=scale, kernel_shape=kernel_shape) 
 			# .Dropout('drop', 0.75)
 			())
 		return x
 
 ###############################################################################
 @auto_reuse_variable_scope
-def arch_generator(image, style, last_dim=3):
+def arch_generator(image, style, last_dim=3, config=None, lut=None, projection=None):
+	config = config or get_preset('default')
+	checkpoint = config.checkpoint
 	assert image is not None
 	assert style is not None
-	with argscope([Conv2D, Deconv2D], nl=INLReLU, kernel_shape=3, stride=2, padding='SAME'):
+	with argscope([Conv2D, Deconv2D], nl=INLReLU, kernel_shape=config.kernel_shape, stride=config.stride, padding='SAME'), \
+			argscope([residual_enc, residual_dec, Subpix2D], kernel_shape=config.kernel_shape), \
+			argscope(residual_enc, stride=config.stride), \
+			argscope(residual_dec, scale=config.scale):
 		# image = tf.concat([image, style], axis=-1)
-		i0 = residual_enc('i0', image, NB_FILTERS*1)
-		i1 = residual_enc('i1',    i0, NB_FILTERS*2)
-		i2 = residual_enc('i2',    i1, NB_FILTERS*4)
-		i3 = residual_enc('i3',    i2, NB_FILTERS*8)
+		i0 = residual_enc('i0', image, NB_FILTERS*1, checkpoint=0 in checkpoint)
+		i1 = residual_enc('i1',    i0, NB_FILTERS*2, checkpoint=1 in checkpoint)
+		i2 = residual_enc('i2',    i1, NB_FILTERS*4, checkpoint=2 in checkpoint)
+		i3 = residual_enc('i3',    i2, NB_FILTERS*8, checkpoint=3 in checkpoint)
+		if lut is not None:
+			# Condition the bottleneck on the transfer function, one bias per channel
+			shift = FullyConnected('lut', lut / 255.0, NB_FILTERS*8, nl=tf.identity, use_bias=True)
+			shift = tf.reshape(shift, [-1, NB_FILTERS*8, 1, 1] if config.data_format == 'NCHW' else [-1, 1, 1, NB_FILTERS*8])
+			i3 = i3 + shift
+		if projection is not None:
+			# Condition the bottleneck on the projection mode the same way
+			shift = FullyConnected('projection', projection, NB_FILTERS*8, nl=tf.identity, use_bias=True)
+			shift = tf.reshape(shift, [-1, NB_FILTERS*8, 1, 1] if config.data_format == 'NCHW' else [-1, 1, 1, NB_FILTERS*8])
+			i3 = i3 + shift
 
 		# s0 = residual_enc('s0', style, NB_FILTERS*1)
 		# s1 = residual_enc('s1',    s0, NB_FILTERS*2)
@@ -469,39 +915,149 @@ def arch_generator(image, style, last_dim=3):
 		# s3 = residual_enc('s3',    s2, NB_FILTERS*8)
 
 		# d4 = tf.concat([i3, s3], axis=-1)
-		d3 = residual_dec('d3',    i3, NB_FILTERS*4)
-		d2 = residual_dec('d2', d3+i2, NB_FILTERS*2)
-		d1 = residual_dec('d1', d2+i1, NB_FILTERS*1)
-		d0 = residual_dec('d0', d1+i0, NB_FILTERS*1) 
+		d3 = residual_dec('d3',    i3, NB_FILTERS*4, checkpoint=3 in checkpoint)
+		d2 = residual_dec('d2', d3+i2, NB_FILTERS*2, checkpoint=2 in checkpoint)
+		d1 = residual_dec('d1', d2+i1, NB_FILTERS*1, checkpoint=1 in checkpoint)
+		d0 = residual_dec('d0', d1+i0, NB_FILTERS*1, checkpoint=0 in checkpoint) 
 		dd =  (LinearWrap(d0)
-				.Conv2D('dd', last_dim, kernel_shape=3, stride=1, padding='SAME', nl=tf.tanh, use_bias=True) ())
+				.Conv2D('dd', last_dim, kernel_shape=config.kernel_shape, stride=1, padding='SAME', nl=tf.tanh, use_bias=True) ())
 		return dd
+def volume_rendering(volume, depth):
+	"""
+	volume: [b, y, x, 4*depth] generator output in tanh range, RGB and alpha of each slice, 
+	        slice 0 in front
+	Returns the rendering [b, y, x, 3] in tanh range and the alphas [b, y, x, depth] in [0, 1]
+	"""
+	with tf.name_scope('volume_rendering'):
+		shape = tf.shape(volume)
+		volume = tf.reshape(volume, tf.stack([shape[0], shape[1], shape[2], depth, 4]))
+		volume = (volume + 1.0) / 2.0
+		color = tf.transpose(volume[..., 0:3], [0, 1, 2, 4, 3])   # [b, y, x, 3, depth]
+		alpha = volume[..., 3]                                    # [b, y, x, depth]
+		tiled = tf.tile(tf.expand_dims(alpha, 3), [1, 1, 1, 3, 1]) # Same opacity for every channel
+		rendering, _ = composite_over(color, tiled)
+		return rendering * 2.0 - 1.0, alpha
+
+###############################################################################
+# Input encoding: reduce the DIMZ*2 slice channels before the first residual_enc
+INPUT_ENCODINGS = ['none', 'compress', 'pool']
+
+def encode_input(image, encoding='none', depth=32):
+	"""
+	image: [b, y, x, 2*dimz], intensity slices followed by alpha slices
+	compress: learned 1x1 conv down to 2*depth channels
+	pool:     average each group of dimz/depth consecutive slices, separately for
+	          intensity and alpha, down to 2*depth channels
+	"""
+	assert encoding in INPUT_ENCODINGS
+	if encoding == 'none':
+		return image
+	with tf.variable_scope('encode'):
+		if encoding == 'compress':
+			return Conv2D('compress', image, 2*depth, kernel_shape=1, stride=1, padding='SAME', nl=tf.identity, 
+						  data_format='NHWC')
+		# The number of slices may be dynamic (progressive training), the output channels are not
+		chan = image.get_shape().as_list()[-1]
+		assert chan is None or chan % (2*depth) == 0, 'Depth {} does not divide {} slices'.format(depth, chan // 2)
+		shape = tf.shape(image)
+		pooled = tf.reshape(image, tf.stack([shape[0], shape[1], shape[2], 2, depth, -1]))
+		pooled = tf.reduce_mean(pooled, axis=-1)
+		pooled = tf.reshape(pooled, tf.stack([shape[0], shape[1], shape[2], 2*depth]))
+		pooled.set_shape(image.get_shape()[:-1].concatenate([2*depth]))
+		return pooled
+
+###############################################################################
+# Layout
+def to_data_format(x, data_format):
+	return tf.transpose(x, [0, 3, 1, 2]) if data_format == 'NCHW' else x
+
+def to_nhwc(x, data_format):
+	return tf.transpose(x, [0, 2, 3, 1]) if data_format == 'NCHW' else x
+
+def benchmark_data_format(data_format, chan=NB_FILTERS*2, size=128, iters=10):
+	"""
+	Seconds per run of a residual-like stack of dilated 3x3 convs in data_format,
+	inf when the layout is not supported here (e.g. NCHW on plain CPU builds).
+	"""
+	with tf.Graph().as_default():
+		shape = [1, size, size, chan] if data_format == 'NHWC' else [1, chan, size, size]
+		x = tf.random_normal(shape)
+		for rate in [1, 2, 4, 8, 1]:
+			w = tf.random_normal([3, 3, chan, chan])
+			x = tf.nn.convolution(x, w, padding='SAME', dilation_rate=[rate, rate], data_format=data_format)
+			x = tf.nn.leaky_relu(x)
+		op = tf.reduce_sum(x)
+		try:
+			with tf.Session() as sess:
+				sess.run(op) # Warm up
+				start = time.time()
+				for _ in range(iters):
+					sess.run(op)
+				return (time.time() - start) / iters
+		except (tf.errors.OpError, ValueError) as e:
+			logger.info('{} is not available: {}'.format(data_format, e))
+			return float('inf')
+
+def select_data_format(**kwargs):
+	timings = {data_format: benchmark_data_format(data_format, **kwargs) for data_format in ['NHWC', 'NCHW']}
+	logger.info('Layout timings (s/run): {}'.format(timings))
+	return min(timings, key=timings.get)
+
 ####################################################################################################
 class Model(ModelDesc):
+	def __init__(self, config=None):
+		super(Model, self).__init__()
+		self.config         = config or get_preset('default')
+		self.checkpoint     = self.config.checkpoint
+		self.encoding       = self.config.encoding
+		self.encoding_depth = self.config.encoding_depth
+		self.input_dtype    = tf.as_dtype(self.config.input_dtype)
+		self.data_format    = self.config.data_format
+		assert self.data_format in ['NHWC', 'NCHW'], 'Resolve auto with select_data_format first'
+
 	def _get_inputs(self):
+		# Trained at several resolutions or on patches: spatial dims are dynamic, and so is 
+		# the number of slices when the pooled encoding makes it irrelevant
+		dimy, dimx, dimz = DIMY, DIMX, DIMZ
+		if self.config.min_resolution != DIMX:
+			dimy, dimx = None, None
+			dimz = None if self.encoding == 'pool' else DIMZ
+		lut = [InputDesc(tf.float32, (None, 256), 'lut')] if self.config.lut_input else []
+		if self.config.projection_input:
+			lut.append(InputDesc(tf.float32, (None, len(PROJECTION_MODES)), 'projection'))
+		if self.config.graph_augment:
+			return [
+				# Raw volume and rotation angle, graph_project makes the input and the projection
+				InputDesc(tf.uint8,   (None, dimy, dimx, dimz), 'image'),
+				InputDesc(tf.float32, (None, dimy, dimx,    3), 'style'),
+				InputDesc(tf.float32, (None,),                  'angle'),
+				] + lut
 		return [
-			InputDesc(tf.float32, (None, DIMY, DIMX, DIMZ*2), 'image'), # un comment line image = np.expand_dims
+			# uint8 volumes are cast on the device, a quarter of the float32 host-to-device traffic
+			InputDesc(self.input_dtype, (None, dimy, dimx, dimz and dimz*2), 'image'), # un comment line image = np.expand_dims
 			# InputDesc(tf.float32, (DIMZ, DIMY, DIMX,    1), 'image'),
-			InputDesc(tf.float32, (None, DIMY, DIMX,    3), 'style'),
-			InputDesc(tf.float32, (None, DIMY, DIMX,    3), 'img2d'),
-			]
+			InputDesc(tf.float32, (None, dimy, dimx,    3), 'style'),
+			InputDesc(tf.float32, (None, dimy, dimx,    3), 'img2d'),
+			] + lut
 	#Fuse 2 branches of the image
 	@auto_reuse_variable_scope
-	def generator(self, image, style, last_dim=3):
-		return arch_generator(image, style, last_dim=last_dim)
+	def generator(self, image, style, last_dim=3, lut=None, projection=None):
+		return arch_generator(image, style, last_dim=last_dim, config=self.config, lut=lut, projection=projection)
 
 	def _build_graph(self, inputs):
 		G = tf.get_default_graph() # For round
 		tf.local_variables_initializer()
 		tf.global_variables_initializer()
-		I, S, P = inputs # Get the image I and style S and Projection img2d P
+		I, S, P = inputs[:3] # Get the image I and style S and Projection img2d P
+		L = inputs[3] if self.config.lut_input else None # Transfer function of each sample
+		M = inputs[3 + self.config.lut_input] if self.config.projection_input else None # Projection mode of each sample
+		if self.config.graph_augment:
+			I, P = graph_project(I, P, default_lut('numpy') if L is None else L) # P is the rotation angle until here
 
-		print(I)
-		print(S)
-		
+		logger.info('Inputs: image {}, style {}'.format(I.get_shape().as_list(), S.get_shape().as_list()))
 
 		# Convert to range tanh
-		I = tf_2tanh(I)
+		I = tf_2tanh(tf.cast(I, tf.float32))
 		S = tf_2tanh(S)
 		P = tf_2tanh(P)
 
@@ -509,10 +1065,20 @@ class Model(ModelDesc):
 					  W_init=tf.truncated_normal_initializer(stddev=0.02),
 					  use_bias=False), \
 				argscope(BatchNorm, gamma_init=tf.random_uniform_initializer()), \
-				argscope([Conv2D, Deconv2D, BatchNorm], data_format='NHWC'), \
+				argscope([Conv2D, Deconv2D, BatchNorm, InstanceNorm, MaxPooling, Subpix2D], data_format=self.data_format), \
 				argscope([Conv2D], dilation_rate=1):
-			with tf.variable_scope('gen'):
-				R = self.generator(I, S, last_dim=3) # Generate the rendering from image I
+			# Recomputed blocks go through tf.custom_gradient, which only accepts resource variables
+			with tf.variable_scope('gen', use_resource=True if self.checkpoint else None):
+				E = encode_input(I, self.encoding, self.encoding_depth)
+				E = to_data_format(E, self.data_format) # The only transpose on the way in
+				if self.config.volume_depth:
+					# Per-slice RGB and alpha, composited in the graph
+					V = self.generator(E, S, last_dim=4*self.config.volume_depth, lut=L, projection=M)
+					V = to_nhwc(V, self.data_format)
+					R, V_alpha = volume_rendering(V, self.config.volume_depth)
+				else:
+					R = self.generator(E, S, last_dim=3, lut=L, projection=M) # Generate the rendering from image I
+					R = to_nhwc(R, self.data_format)
 
 
 		# Calculating loss goes here
@@ -530,7 +1096,7 @@ class Model(ModelDesc):
 				assert isinstance(v, tf.Tensor)
 				v.get_shape().assert_has_rank(4)
 				dim = v.get_shape().as_list()
-				v = tf.reshape(v, [-1, dim[1] * dim[2], dim[3]])
+				v = tf.reshape(v, [tf.shape(v)[0], -1, dim[3]])
 				return tf.matmul(v, v, transpose_a=True)
 	
 			with tf.variable_scope(name):
@@ -538,9 +1104,11 @@ class Model(ModelDesc):
 				#x = tf.reshape(x, [2 * BATCH_SIZE, SHAPE_LR * 4, SHAPE_LR * 4, 3]) * 255.0
 				x = tf_2imag(x) # convert to range img2d
 				x = x - VGG_MEAN_TENSOR
+				x = to_data_format(x, self.data_format)
 				# VGG 19
 				with varreplace.freeze_variables():
-					with argscope(Conv2D, kernel_shape=3, nl=tf.nn.relu):
+					with argscope(Conv2D, kernel_shape=3, nl=tf.nn.relu), \
+							argscope([Conv2D, MaxPooling], data_format=self.data_format):
 						conv1_1 = Conv2D('conv1_1', x, 64)
 						conv1_2 = Conv2D('conv1_2', conv1_1, 64)
 						pool1 = MaxPooling('pool1', conv1_2, 2)  # 64
@@ -563,6 +1131,11 @@ class Model(ModelDesc):
 						conv5_4 = Conv2D('conv5_4', conv5_3, 512)
 						pool5 = MaxPooling('pool5', conv5_4, 2)  # 4
 
+				# The losses work on NHWC features
+				pool2, pool5 = to_nhwc(pool2, self.data_format), to_nhwc(pool5, self.data_format)
+				conv1_1, conv2_1, conv3_1, conv4_1, conv5_1 = [to_nhwc(v, self.data_format) 
+					for v in [conv1_1, conv2_1, conv3_1, conv4_1, conv5_1]]
+
 				# perceptual loss
 				with tf.name_scope('perceptual_loss'):
 					pool2 = normalize(pool2)
@@ -583,11 +1156,12 @@ class Model(ModelDesc):
 					def texture_loss(x, p=16):
 						_, h, w, c = x.get_shape().as_list()
 						x = normalize(x)
-						assert h % p == 0 and w % p == 0
+						assert h is None or (h % p == 0 and w % p == 0)
 						logger.info('Create texture loss for layer {} with shape {}'.format(x.name, x.get_shape()))
+						h, w = tf.shape(x)[1], tf.shape(x)[2]
 
 						x = tf.space_to_batch_nd(x, [p, p], [[0, 0], [0, 0]])  # [b * ?, h/p, w/p, c]
-						x = tf.reshape(x, [p, p, -1, h // p, w // p, c])       # [p, p, b, h/p, w/p, c]
+						x = tf.reshape(x, tf.stack([p, p, -1, h // p, w // p, c])) # [p, p, b, h/p, w/p, c]
 						x = tf.transpose(x, [2, 3, 4, 0, 1, 5])                # [b * ?, p, p, c]
 						patches_a, _, patches_b = tf.split(x, 3, axis=0)       # each is b,h/p,w/p,p,p,c; 	split to render, _image, style
 
@@ -599,11 +1173,15 @@ class Model(ModelDesc):
 							reduction=tf.losses.Reduction.MEAN
 						)
 
-					texture_loss_conv1_1 = tf.identity(texture_loss(conv1_1), name='normalized_conv1_1')
-					texture_loss_conv2_1 = tf.identity(texture_loss(conv2_1), name='normalized_conv2_1')
-					texture_loss_conv3_1 = tf.identity(texture_loss(conv3_1), name='normalized_conv3_1')
-					texture_loss_conv4_1 = tf.identity(texture_loss(conv4_1), name='normalized_conv4_1')
-					texture_loss_conv5_1 = tf.identity(texture_loss(conv5_1), name='normalized_conv5_1')
+					# Patches have to fit the smallest feature map the graph is trained at
+					def patch(level, p=16):
+						return min(p, self.config.min_resolution >> level)
+
+					texture_loss_conv1_1 = tf.identity(texture_loss(conv1_1, patch(0)), name='normalized_conv1_1')
+					texture_loss_conv2_1 = tf.identity(texture_loss(conv2_1, patch(1)), name='normalized_conv2_1')
+					texture_loss_conv3_1 = tf.identity(texture_loss(conv3_1, patch(2)), name='normalized_conv3_1')
+					texture_loss_conv4_1 = tf.identity(texture_loss(conv4_1, patch(3)), name='normalized_conv4_1')
+					texture_loss_conv5_1 = tf.identity(texture_loss(conv5_1, patch(4)), name='normalized_conv5_1')
 
 					add_moving_summary(texture_loss_conv1_1)
 					add_moving_summary(texture_loss_conv2_1)
@@ -653,6 +1231,17 @@ class Model(ModelDesc):
 		add_moving_summary(tv_loss)
 		loss.append(tf.multiply(5e-6, tv_loss, name="total_variation"))		
 
+		if self.config.volume_depth and self.config.volume_alpha:
+			# Keep the predicted opacities close to the transfer function of the input volume
+			with tf.name_scope('volume_loss'):
+				dimz = tf.shape(I)[-1] // 2
+				shape = tf.shape(I)
+				target = tf.reshape(I[..., dimz:], tf.stack([shape[0], shape[1], shape[2], self.config.volume_depth, -1]))
+				target = (tf.reduce_mean(target, axis=-1) + 1.0) / 2.0 # tanh range to [0, 1]
+				alpha_loss = tf.reduce_mean(tf.abs(V_alpha - target), name='alpha_loss')
+				add_moving_summary(alpha_loss)
+			loss.append(tf.multiply(self.config.volume_alpha, alpha_loss, name="loss_VA"))
+
 		if get_current_tower_context().is_training:
 			self.cost = tf.add_n(loss, name='cost')
 			add_moving_summary(self.cost)
@@ -663,7 +1252,8 @@ class Model(ModelDesc):
 			viz = tf.cast(tf.clip_by_value(viz, 0, 255), tf.uint8, name=name)
 			tf.summary.image(name, viz, max_outputs=30) #max(30, BATCH_SIZE)
 
-		visualize(tf.transpose(I[...,128-2:128+2,:,:], [1, 2, 3, 0]), name='viz_image')
+		mid = tf.shape(I)[1] // 2 # Rows around the center of the volume
+		visualize(tf.transpose(I[:,mid-2:mid+2,:,:], [1, 2, 3, 0]), name='viz_image')
 		visualize(P, name='viz_img2d')
 		visualize(S, name='viz_style')
 		visualize(R, name='rendering')
@@ -673,6 +1263,51 @@ class Model(ModelDesc):
 		opt = tf.train.AdamOptimizer(lr)
 		return opt
 
+###################################################################################################
+class ProgressiveSchedule(object):
+	"""
+	Resolution of the training volumes per epoch, e.g. [(1, 64), (50, 128), (100, 256)].
+	The current resolution lives in shared memory so that the prefetching processes,
+	forked before training starts, follow the updates made by ProgressiveResolution.
+	"""
+	def __init__(self, stages):
+		self.stages = sorted(stages)
+		for _, res in self.stages:
+			assert DIMX % res == 0 and DIMY % res == 0 and DIMZ % res == 0, res
+		self._resolution = multiprocessing.Value('i', self.stages[0][1])
+
+	@staticmethod
+	def parse(text):
+		# "1:64,50:128,100:256"
+		return ProgressiveSchedule([tuple(int(v) for v in stage.split(':')) for stage in text.split(',')])
+
+	def min_resolution(self):
+		return min(res for _, res in self.stages)
+
+	def resolution_at(self, epoch):
+		res = self.stages[0][1]
+		for start, stage_res in self.stages:
+			if epoch >= start:
+				res = stage_res
+		return res
+
+	def resolution(self):
+		return self._resolution.value
+
+	def set_epoch(self, epoch):
+		self._resolution.value = self.resolution_at(epoch)
+
+
+class ProgressiveResolution(Callback):
+	def __init__(self, schedule):
+		self.schedule = schedule
+
+	def _before_epoch(self):
+		old = self.schedule.resolution()
+		self.schedule.set_epoch(self.epoch_num)
+		if self.schedule.resolution() != old:
+			logger.info('Training resolution {} -> {}'.format(old, self.schedule.resolution()))
+
 ###################################################################################################
 class VisualizeRunner(Callback):
 	def _setup_graph(self):
@@ -692,20 +1327,146 @@ class VisualizeRunner(Callback):
 
 			self.trainer.monitors.put_image('viz_valid', viz_valid)
 ###################################################################################################
-def apply(model_path, image_path, alpha_path, style_path):
-	pass
+def tile_weights(height, width, overlap):
+	# Linear ramps over the overlap, never zero so that every pixel gets some weight
+	def ramp(n):
+		r = np.minimum(np.arange(1, n+1), np.arange(n, 0, -1)).astype(np.float32)
+		return np.minimum(r / (overlap + 1.0), 1.0)
+	return np.outer(ramp(height), ramp(width))[..., None]
+
+def tile_starts(size, tile, overlap):
+	if size <= tile:
+		return [0]
+	step = tile - overlap
+	starts = list(range(0, size - tile, step))
+	return starts + [size - tile]
+
+def tiled_render(predict, read, shape, style, tile=256, overlap=32, multiple=16):
+	"""
+	Render a volume of any size tile by tile and blend the seams.
+
+	predict: function mapping ([1, th, tw, c] image, [1, th, tw, 3] style) to a [1, th, tw, 3] rendering
+	read:    function mapping the (rows, columns) slices of a tile to its [th, tw, c] image, the
+	         slices (and alpha) as channels
+	shape:   (y, x) size of the volume
+	style:   [y, x, 3] style, the same size as the volume
+	Only the window of one tile of the volume is in memory at a time. The tiles overlap by
+	overlap pixels and are blended with linear ramps, the tile size has to be a multiple of
+	the generator downsampling.
+	"""
+	assert tile % multiple == 0 and overlap < tile
+	height, width = shape
+	# Every tile is tile x tile, pad volumes smaller than that
+	pady, padx = max(tile - height, 0), max(tile - width, 0)
+	if pady or padx:
+		style = np.pad(style, ((0, pady), (0, padx), (0, 0)), mode='reflect')
+	dimy, dimx = height + pady, width + padx
+
+	result = np.zeros((dimy, dimx, 3), dtype=np.float32)
+	weight = np.zeros((dimy, dimx, 1), dtype=np.float32)
+	window = tile_weights(tile, tile, overlap)
+	for y0 in tile_starts(dimy, tile, overlap):
+		for x0 in tile_starts(dimx, tile, overlap):
+			image = read(slice(y0, min(y0+tile, height)), slice(x0, min(x0+tile, width)))
+			image = np.pad(image, ((0, tile - image.shape[0]), (0, tile - image.shape[1]), (0, 0)), mode='constant')
+			rendering = predict(image[None], style[None, y0:y0+tile, x0:x0+tile])
+			result[y0:y0+tile, x0:x0+tile] += window * np.squeeze(rendering, axis=0)
+			weight[y0:y0+tile, x0:x0+tile] += window
+	return (result / weight)[:height, :width]
+
+def apply(model_path, image_path, style_path, alpha_path=None, config=None, output='.', tile=256, overlap=32, mode='over', 
+		  reference=False, cache_dir=None):
+	# The graph augmentation only shapes the training inputs, inference takes the composited volume
+	# The generator renders in the projection mode (when it takes one). With reference, the host 
+	# projection of the same slices is saved next to the rendering, streamed slab by slab through 
+	# the content box
+	config = (config or get_preset('default')).replace(min_resolution=tile, graph_augment=False)
+	pred_config = PredictConfig(
+		model        = Model(config), 
+		session_init = get_model_loader(model_path), 
+		input_names  = ['image', 'style'] + (['lut'] if config.lut_input else []) + (['projection'] if config.projection_input else []), 
+		output_names = ['rendering'])
+	predictor = OfflinePredictor(pred_config)
+	# Render with the first transfer function of the bank
+	lut = LUTBank(alpha_path)[0] if alpha_path else default_lut(config.renderer)
+	def predict(image, style):
+		extra = [lut[None]] if config.lut_input else []
+		extra += [projection_code(mode)] if config.projection_input else []
+		return predictor(image, style, *extra)[0]
+
+	style = skimage.io.imread(natsorted(glob.glob(style_path + '/*.*'))[0])
+	if style.ndim == 2:
+		style = skimage.color.gray2rgb(style)
+	index = VolumeIndex(image_path, cache_dir) if reference else None
+	for filename in natsorted(glob.glob(image_path + '/*.*')):
+		with contextlib.closing(open_volume(filename)) as volume: # Lazy, the tiles read their own windows
+			apply_volume(predict, volume, filename, style, lut, output, tile, overlap, mode if reference else None, index)
+
+def apply_volume(predict, volume, filename, style, lut, output, tile, overlap, reference=None, index=None):
+	# The generator takes DIMZ slices, deeper volumes keep their middle ones
+	depth = volume.shape[0]
+	start = (depth - DIMZ + 1) // 2 if depth > DIMZ else 0
+	slices = slice(start, start + min(depth, DIMZ))
+	def read(rows, cols):
+		block = np.transpose(volume.read(z=slices, y=rows, x=cols), [1, 2, 0]) # Make dimz is the last channel
+		if block.shape[-1] < DIMZ:
+			block = np.pad(block, ((0, 0), (0, 0), (0, DIMZ - block.shape[-1])), mode='constant')
+		return np.concatenate((block, apply_lut(lut, block)), axis=-1).astype(np.float32)
+	style_ = cv2.resize(style[...,0:3], (volume.shape[2], volume.shape[1])).astype(np.float32)
+	rendering = tiled_render(predict, read, volume.shape[1:], style_, tile=tile, overlap=overlap)
+	name = os.path.splitext(os.path.basename(filename))[0]
+	skimage.io.imsave(os.path.join(output, name + '.png'), np.clip(rendering, 0, 255).astype(np.uint8))
+	if reference:
+		color, _ = composite_volume(volume, lut, box=index.box(filename), mode=reference, zs=slices)
+		skimage.io.imsave(os.path.join(output, name + '_reference.png'), np.clip(color * 255.0, 0, 255).astype(np.uint8))
 
 ###################################################################################################
-if __name__ == '__main__':
+def main(preset='default', argv=None):
+	global args
 	parser = argparse.ArgumentParser()
+	parser.add_argument('--preset', help='generator variant', default=preset, choices=sorted(GENERATOR_PRESETS))
 	parser.add_argument('--gpu', 	help='comma separated list of GPU(s) to use.')
 	parser.add_argument('--load', 	help='load model')
 	parser.add_argument('--apply', 	action='store_true')
+	parser.add_argument('--reference', help='with --apply, also save the numpy projection (first --projection mode) of the same slices', action='store_true')
 	parser.add_argument('--image', 	help='path to the image. ', default="data/image_3d/")
 	parser.add_argument('--style',  help='path to the style. ', default="data/style_chinese/")
+	parser.add_argument('--alpha', 	help='transfer functions, a compiled .npy bank or a directory of them', default=None)
 	parser.add_argument('--vgg19', 	help='load model', 			default="data/vgg19.npz")
 	parser.add_argument('--output', help='directory for saving the rendering', default=".", type=str)
-	args = parser.parse_args()
+	parser.add_argument('--checkpoint', help='comma separated scales (0-3) whose residual blocks are recomputed in backprop', default="")
+	parser.add_argument('--memory_report', help='print the activation memory per checkpoint configuration', action='store_true')
+	parser.add_argument('--encoding', help='input encoding of the volume slices', default='none', choices=INPUT_ENCODINGS)
+	parser.add_argument('--encoding_depth', help='slices kept per channel group by the input encoding', default=32, type=int)
+	parser.add_argument('--uint8', help='ship the volume as uint8 and cast on the device', action='store_true')
+	parser.add_argument('--progressive', help='epoch:resolution stages, e.g. 1:64,50:128,100:256', default="")
+	parser.add_argument('--patch', 	help='train on patches of this size instead of whole frames', default=None, type=int)
+	parser.add_argument('--io_workers', help='concurrent volume/style reads per dataflow process', default=4, type=int)
+	parser.add_argument('--io_depth', help='samples read ahead per dataflow process', default=4, type=int)
+	parser.add_argument('--elastic', help='elastic deformation of the training volumes', default=None, choices=['2d', '3d'])
+	parser.add_argument('--pyramid', help='read the low-resolution stages from volume pyramids', default=None, choices=PYRAMID_MODES)
+	parser.add_argument('--projection', help='comma separated projection modes of the ground truth, one drawn per sample and '
+						'fed to the generator, among ' + ','.join(PROJECTION_MODES) + ' (--apply renders in the first one)', default='over')
+	parser.add_argument('--sample_step', help='slices per sample of the ground-truth rays, pre-integrated', default=1, type=int)
+	parser.add_argument('--preintegration_report', help='time and compare the sample steps on the first volume', action='store_true')
+	parser.add_argument('--shading', help='Blinn-Phong shading of the ground-truth projection', action='store_true')
+	parser.add_argument('--luts_per_sample', help='transfer functions of the --alpha bank composited per volume pass', default=1, type=int)
+	parser.add_argument('--fixed_point', help='composite the ground truth in integer arithmetic', action='store_true')
+	parser.add_argument('--fixed_point_report', help='time and check the fixed point compositing on the first volume', action='store_true')
+	parser.add_argument('--sparse_report', help='time the sparse against the dense compositing on the first volume', action='store_true')
+	parser.add_argument('--sparse', help='rotate and composite the volumes with at most this fraction of occupied bricks sparsely', default=0.0, type=float)
+	parser.add_argument('--cache_dir', help='writable directory for the volume index and pyramids, the data directory by default', default=None)
+	parser.add_argument('--brick_cache', help='MB of compressed volume bricks shared by the prefetch workers', default=0, type=int)
+	parser.add_argument('--color_tf', help='RGBA transfer function of the ground truth, rows of intensity r g b alpha', default=None)
+	parser.add_argument('--seed', 	help='seed of the per-sample random streams', default=2015, type=int)
+	parser.add_argument('--graph_augment', help='rotate and composite the training volumes in the graph', action='store_true')
+	parser.add_argument('--volume_depth', help='predict color and alpha of this many slices and composite them', default=0, type=int)
+	parser.add_argument('--volume_alpha', help='weight of the L1 loss on the predicted alphas', default=0.0, type=float)
+	parser.add_argument('--data_format', help='layout of the networks, auto times both on this host', default='NHWC', 
+						choices=['NHWC', 'NCHW', 'auto'])
+	parser.add_argument('--tile', 	help='tile size for --apply', default=256, type=int)
+	parser.add_argument('--overlap', help='overlap between the tiles of --apply', default=32, type=int)
+	args = parser.parse_args(argv)
 	print(args)
 	parser.print_help()
 
@@ -713,25 +1474,96 @@ if __name__ == '__main__':
 	if args.gpu:
 		os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
 
-	if args.apply:
-		apply(args.load, args.image, args.style)
+	checkpoint = [int(k) for k in args.checkpoint.split(',') if k != '']
+	gen_config = get_preset(args.preset).replace(
+		checkpoint=checkpoint, 
+		encoding=args.encoding, 
+		encoding_depth=args.encoding_depth, 
+		input_dtype='uint8' if args.uint8 else 'float32', 
+		data_format=args.data_format, 
+		graph_augment=args.graph_augment, 
+		volume_depth=args.volume_depth, 
+		volume_alpha=args.volume_alpha, 
+		lut_input=bool(args.alpha), 
+		projection_input=len(args.projection.split(',')) > 1)
+	if gen_config.data_format == 'auto':
+		gen_config = gen_config.replace(data_format=select_data_format())
+	schedule = None
+	if args.progressive:
+		schedule = ProgressiveSchedule.parse(args.progressive)
+		# The slices are input channels, only the pooled encoding keeps their count fixed
+		assert gen_config.encoding == 'pool', 'Progressive training needs --encoding pool'
+		assert gen_config.renderer == 'numpy', 'The vtk renderer only renders at full resolution'
+		gen_config = gen_config.replace(min_resolution=schedule.min_resolution())
+	if args.patch:
+		assert args.patch % gen_config.stride**4 == 0, 'Patches have to survive the encoder downsampling'
+		assert gen_config.renderer == 'numpy', 'The vtk projection is not aligned with the volume columns'
+		gen_config = gen_config.replace(patch_size=args.patch, min_resolution=min(args.patch, gen_config.min_resolution))
+	if gen_config.volume_depth:
+		assert DIMZ % gen_config.volume_depth == 0, 'The alpha loss pools the slices in groups of DIMZ/volume_depth'
+	projection = args.projection.split(',')
+	assert not (args.shading and args.sample_step > 1), 'The pre-integration tables are built from unshaded colors'
+	assert all(mode in PROJECTION_MODES for mode in projection), projection
+	if args.fixed_point:
+		assert gen_config.renderer == 'numpy' and not gen_config.graph_augment, 'The fixed point kernel is a numpy compositor'
+		assert not args.color_tf and args.sample_step == 1, 'The fixed point kernel composites gray over operators'
+		verify_fixed()
+	if args.sparse:
+		assert gen_config.renderer == 'numpy' and not gen_config.graph_augment, 'The sparse volumes are composited by numpy'
+		assert not (args.shading or args.fixed_point or args.color_tf or args.sample_step > 1), \
+			'The sparse compositing is the plain gray over operator'
+	if args.color_tf:
+		assert not args.alpha, 'One color transfer function or a bank of opacities'
+		assert not args.shading and args.sample_step == 1 and not gen_config.graph_augment, \
+			'The color transfer function is only composited by the plain numpy over operator'
+	if args.luts_per_sample > 1:
+		assert args.alpha, 'Several transfer functions per sample come from the --alpha bank'
+		assert gen_config.renderer == 'numpy' and not gen_config.graph_augment, 'Only the numpy compositor takes a stack of LUTs'
+	if gen_config.graph_augment:
+		assert projection == ['over'], 'The graph compositor only implements the over operator'
+		assert gen_config.renderer == 'numpy', 'Only the numpy compositing has a graph counterpart'
+		assert not gen_config.patch_size, 'Patches are cropped from the rotated volume on the host'
+	logger.info(gen_config)
+
+	if args.memory_report:
+		print_memory_report(gen_config)
+	elif args.preintegration_report:
+		print_preintegration_report(list_files(args.image)[0], default_lut(gen_config.renderer))
+	elif args.sparse_report:
+		print_sparse_report(list_files(args.image)[0], default_lut(gen_config.renderer))
+	elif args.fixed_point_report:
+		print_fixed_point_report(list_files(args.image)[0], default_lut(gen_config.renderer))
+	elif args.apply:
+		apply(args.load, args.image, args.style, alpha_path=args.alpha, config=gen_config, output=args.output, tile=args.tile, overlap=args.overlap, 
+			  mode=projection[0], reference=args.reference, cache_dir=args.cache_dir)
 	else:
 		# Set the logger directory
 		logger.auto_set_dir()
 
 		nr_tower = max(get_nr_gpu(), 1)
 		# ds_train, ds_valid = QueueInput(get_data(args.image, args.style))
-		ds_train, ds_valid = get_data(args.image, args.style)
+		ds_train, ds_valid = get_data(args.image, args.style, alpha_path=args.alpha, dtype=gen_config.input_dtype, renderer=gen_config.renderer, 
+									  schedule=schedule, patch_size=gen_config.patch_size, 
+									  io_workers=args.io_workers, io_depth=args.io_depth, seed=args.seed, 
+									  elastic=args.elastic, graph_augment=gen_config.graph_augment, pyramid=args.pyramid, 
+									  projection=projection, sample_step=args.sample_step, shading=args.shading, 
+									  luts_per_sample=args.luts_per_sample, color_tf=args.color_tf, 
+									  fixed_point=args.fixed_point, sparse=args.sparse, 
+									  brick_cache=args.brick_cache, cache_dir=args.cache_dir)
 
 		ds_train = PrintData(ds_train)
 		ds_valid = PrintData(ds_valid)
 
-		ds_train = PrefetchDataZMQ(ds_train, 4)
-		ds_valid = PrefetchDataZMQ(ds_valid, 1)
+		# Workers write the samples into shared-memory slots instead of pickling them over ZMQ
+		slot_bytes = sample_nbytes(gen_config)
+		ds_train = PrefetchDataSHM(ds_train, gen_config.nr_prefetch, slot_bytes=slot_bytes)
+		ds_valid = PrefetchDataSHM(ds_valid, 1, slot_bytes=slot_bytes)
 		
 
 
-		model = Model()
+		model = Model(gen_config)
+		rows, total = generator_memory_report(gen_config)
+		logger.info('Estimated generator activation memory: {:.1f} MB'.format(total / 2.0**20))
 
 		if args.load:
 			session_init = SaverRestore(args.load)
@@ -743,10 +1575,11 @@ if __name__ == '__main__':
 
 		
 			# Set up configuration
+			callbacks = [ProgressiveResolution(schedule)] if schedule else []
 			config = TrainConfig(
 				model           =   model, 
 				dataflow        =   ds_train,
-				callbacks       =   [
+				callbacks       =   callbacks + [
 					PeriodicTrigger(ModelSaver(), every_k_epochs=50),
 					# PeriodicTrigger(VisualizeRunner(), every_k_epochs=5),
 					# PeriodicTrigger(InferenceRunner(ds_valid, [ScalarStats('loss_membr')]), every_k_epochs=5),
@@ -762,6 +1595,6 @@ if __name__ == '__main__':
 			# Train the model
 			SyncMultiGPUTrainer(config).train()
 
-	
-	
-		
\ No newline at end of file
+###################################################################################################
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Tran Minh Quan, quantm@unist.ac.kr
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# The rotation, transfer function and compositing of ImageDataFlow.project as graph ops,
+# so the dataflow only ships the raw uint8 volume and the projection is made on the device
+# that runs the model.
+
+import numpy as np
+import tensorflow as tf
+
+###################################################################################################
+def tf_rotate_volume(volume, degrees):
+	"""
+	Rotate every volume [b, y, x, z] by its angle degrees [b] in the plane of x and z, like
+	scipy.ndimage.rotate(axes=(1, 2), reshape=False) but bilinear instead of cubic.
+	The rows are rotated independently as one batch of [x, z] images.
+	"""
+	shape = tf.shape(volume)
+	dimb, dimy, dimx, dimz = shape[0], shape[1], shape[2], shape[3]
+	rows = tf.reshape(volume, [dimb*dimy, dimx, dimz, 1])
+	angles = tf.reshape(tf.tile(tf.expand_dims(degrees * (np.pi / 180.0), 1), [1, dimy]), [-1])
+	rows = tf.contrib.image.rotate(rows, angles, interpolation='BILINEAR')
+	return tf.reshape(rows, shape)
+
+def tf_apply_lut(volume, lut):
+	"""
+	Per-voxel lookup of the 256 entries lut, volume [b, ...] holds intensities in [0, 255].
+	lut is either one table [256] or a table per sample [b, 256].
+	"""
+	index = tf.cast(tf.clip_by_value(volume, 0.0, 255.0), tf.int32) # Truncates like astype(np.uint8)
+	lut = tf.cast(lut, tf.float32)
+	if lut.get_shape().ndims == 1:
+		return tf.gather(lut, index)
+	# Offset the indices of sample k to its own row of the flattened tables
+	offset = tf.reshape(tf.range(tf.shape(index)[0]) * 256, [-1] + [1] * (index.get_shape().ndims - 1))
+	return tf.gather(tf.reshape(lut, [-1]), index + offset)
+
+def tf_composite(color, alpha):
+	"""
+	Over operator along the last axis, index 0 in front, color and alpha in [0, 1].
+	The back to front recurrence of ImageDataFlow.project unrolls to
+		C = sum_z c[z] * prod_{k<z} (1 - a[k])
+	which is one exclusive cumprod and one sum.
+	"""
+	transmittance = tf.cumprod(1.0 - alpha, axis=-1, exclusive=True)
+	return (tf.reduce_sum(color * transmittance, axis=-1),
+			tf.reduce_sum(alpha * transmittance, axis=-1))
+
+def graph_project(volume, degrees, lut):
+	"""
+	volume [b, y, x, z] raw intensities, degrees [b], lut the transfer function [256] or [b, 256].
+	Returns the network input [b, y, x, 2z] (intensities then alphas) and the projection
+	[b, y, x, 3], both in [0, 255] as ImageDataFlow.project makes them.
+	"""
+	with tf.name_scope('graph_project'):
+		volume = tf.cast(volume, tf.float32)
+		volume = tf.clip_by_value(tf_rotate_volume(volume, degrees), 0.0, 255.0)
+		alpha  = tf_apply_lut(volume, lut)
+		color, _ = tf_composite(volume / 255.0, alpha / 255.0)
+		img2d  = tf.clip_by_value(tf.tile(tf.expand_dims(color * 255.0, -1), [1, 1, 1, 3]), 0.0, 255.0)
+		return tf.concat([volume, alpha], axis=-1), img2d
+
+###################################################################################################
+# Differentiable compositing
+def _slices(x):
+	# [..., z] as a TensorArray of the z slices
+	rank = x.get_shape().ndims
+	slices = tf.transpose(x, [rank-1] + list(range(rank-1)))
+	return tf.TensorArray(x.dtype, size=tf.shape(x)[-1]).unstack(slices)
+
+def _stack(array, rank):
+	# Back from a TensorArray of slices to [..., z]
+	return tf.transpose(array.stack(), list(range(1, rank)) + [0])
+
+def _over(color, alpha):
+	# Back to front over operator, the recurrence of ImageDataFlow.project
+	cs, as_ = _slices(color), _slices(alpha)
+	zeros = tf.zeros_like(color[..., 0])
+	def body(z, C, A):
+		c, a = cs.read(z), as_.read(z)
+		return z-1, c + (1-a) * C, a + (1-a) * A
+	_, C, A = tf.while_loop(lambda z, C, A: z >= 0, body, [tf.shape(color)[-1]-1, zeros, zeros], 
+							back_prop=False)
+	return C, A
+
+@tf.custom_gradient
+def composite_over(color, alpha):
+	"""
+	Over operator along the last axis of color and alpha [..., z] in [0, 1], index 0 in front.
+	Returns the composited color and alpha [...].
+
+	Only color and alpha are kept for the backward pass, which marches back to front again:
+	with T[j] = prod_{k<j} (1 - a[k]) the transmittance in front of slice j and Cb[j], Ab[j]
+	the composite of the slices behind it,
+		dC/dc[j] = T[j]
+		dC/da[j] = -T[j] * Cb[j]
+		dA/da[j] =  T[j] * (1 - Ab[j])
+	"""
+	C, A = _over(color, alpha)
+	def grad(gC, gA):
+		rank = color.get_shape().ndims
+		ts = _slices(tf.cumprod(1.0 - alpha, axis=-1, exclusive=True))
+		cs, as_ = _slices(color), _slices(alpha)
+		depth = tf.shape(color)[-1]
+		zeros = tf.zeros_like(gC)
+		def body(z, Cb, Ab, dc, da):
+			c, a, t = cs.read(z), as_.read(z), ts.read(z)
+			dc = dc.write(z, gC * t)
+			da = da.write(z, t * (gA * (1 - Ab) - gC * Cb))
+			return z-1, c + (1-a) * Cb, a + (1-a) * Ab, dc, da
+		_, _, _, dc, da = tf.while_loop(lambda z, *_: z >= 0, body, 
+			[depth-1, zeros, zeros, tf.TensorArray(tf.float32, size=depth), tf.TensorArray(tf.float32, size=depth)], 
+			back_prop=False)
+		return _stack(dc, rank), _stack(da, rank)
+	return (C, A), grad
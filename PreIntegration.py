@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Tran Minh Quan, quantm@unist.ac.kr
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# Pre-integrated transfer functions.
+# Sampling every step slices instead of every slice bands as soon as the transfer function
+# changes faster than the step. Pre-integration composites, once per transfer function, the step
+# slices between a front scalar sf and a back scalar sb (linearly interpolated), into a
+# 256 x 256 table of (color, alpha). The renderer then composites one table entry per segment.
+# With step 1 the table is the transfer function itself and the rendering is unchanged.
+# A stack of K transfer functions gets K tables, built and composited in one pass.
+
+import os, time, hashlib, collections
+
+import numpy as np
+
+from VolumeCompositor import over
+
+###################################################################################################
+def lut_hash(lut):
+	return hashlib.sha1(np.ascontiguousarray(lut, dtype=np.float32).tobytes()).hexdigest()
+
+def build_table(lut, step):
+	"""
+	[256, 256, 2] table of the (color, alpha) in [0, 1] of step slices whose scalars go linearly
+	from sf (front, included) to sb (back, excluded), composited like VolumeCompositor.over.
+	A stack of K luts [K, 256] gives the K tables [K, 256, 256, 2] in one pass.
+	"""
+	lut = np.asarray(lut, dtype=np.float32)
+	sf = np.arange(256, dtype=np.float32)[:, None]
+	sb = np.arange(256, dtype=np.float32)[None, :]
+	color = np.zeros(lut.shape[:-1] + (256, 256), dtype=np.float32)
+	alpha = np.zeros(lut.shape[:-1] + (256, 256), dtype=np.float32)
+	for k in range(step-1, -1, -1): # Back to front
+		s = sf + (sb - sf) * (k / float(step))
+		c = s / 255.0
+		a = np.take(lut, s.astype(np.uint8), axis=-1) / 255.0
+		color = c + (1 - a) * color
+		alpha = a + (1 - a) * alpha
+	return np.stack([color, alpha], axis=-1)
+
+MAX_TABLE_BYTES = 64 << 20 # Of the tables kept in memory per process, 128 single tables
+
+_TABLES = collections.OrderedDict()
+
+def get_table(lut, step, cache_dir=None):
+	"""
+	build_table, memoized by the hash of the transfer function (or the stack of them) and kept in
+	cache_dir if given. The least recently used tables past MAX_TABLE_BYTES are dropped.
+	"""
+	key = (lut_hash(lut), step)
+	if key in _TABLES:
+		_TABLES[key] = _TABLES.pop(key) # Most recently used
+		return _TABLES[key]
+	path = os.path.join(cache_dir, '{}_{}.npy'.format(*key)) if cache_dir else None
+	if path and os.path.exists(path):
+		table = np.load(path)
+	else:
+		table = build_table(lut, step)
+		if path:
+			if not os.path.isdir(cache_dir):
+				os.makedirs(cache_dir)
+			np.save(path, table)
+	_TABLES[key] = table
+	while len(_TABLES) > 1 and sum(t.nbytes for t in _TABLES.values()) > MAX_TABLE_BYTES:
+		_TABLES.popitem(last=False)
+	return table
+
+def composite_preintegrated(color_s, table, step):
+	"""
+	Over operator along the last axis of color_s [..., z] in [0, 255], sampled every step slices.
+	Segment j runs from the sample z = j*step to the next one, the last ends on empty space.
+	With the K tables [K, 256, 256, 2] of a stack of luts the colors are gathered once for all.
+	Returns color and alpha [...] (or [K, ...]) in [0, 1].
+	"""
+	samples = color_s[..., ::step].astype(np.uint8)
+	back = np.concatenate([samples[..., 1:], np.zeros_like(samples[..., :1])], axis=-1)
+	segments = table[..., samples, back, :] # [(K,) ..., n, 2]
+	color = np.zeros(segments.shape[:-2], dtype=np.float32)
+	alpha = np.zeros(segments.shape[:-2], dtype=np.float32)
+	for j in range(segments.shape[-2]-1, -1, -1):
+		c, a = segments[..., j, 0], segments[..., j, 1]
+		color = c + (1 - a) * color
+		alpha = a + (1 - a) * alpha
+	return color, alpha
+
+###################################################################################################
+def benchmark(volume, lut, steps=(1, 2, 3, 4)):
+	"""
+	Rows (step, seconds, PSNR of pre-integration, PSNR of plain subsampling) of the projection of
+	volume [y, x, z] along z, both against the projection of every slice.
+	"""
+	def psnr(a, b):
+		mse = np.mean((a - b) ** 2)
+		return float('inf') if mse == 0 else 10 * np.log10(1.0 / mse)
+	start = time.time()
+	reference, _ = over(volume.astype(np.float32), lut[volume.astype(np.uint8)])
+	rows = [(1, time.time() - start, float('inf'), float('inf'))]
+	for step in steps:
+		if step == 1:
+			continue
+		table = get_table(lut, step)
+		start = time.time()
+		color, _ = composite_preintegrated(volume, table, step)
+		seconds = time.time() - start
+		subsampled = volume[..., ::step].astype(np.float32)
+		naive, _ = over(subsampled, lut[subsampled.astype(np.uint8)])
+		rows.append((step, seconds, psnr(np.clip(color, 0, 1), np.clip(reference, 0, 1)),
+					 psnr(np.clip(naive, 0, 1), np.clip(reference, 0, 1))))
+	return rows
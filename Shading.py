@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Tran Minh Quan, quantm@unist.ac.kr
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# Blinn-Phong shading of the voxel colors before compositing.
+# The normals are the central-difference gradients of the (rotated) volume, encoded as int8
+# (a quarter of float32) together with the gradient magnitude as uint8. They do not depend on
+# the transfer function, so the K transfer functions of a volume share one shade call. Every
+# sample is rotated by its own angle, so nothing is kept from one volume to the next.
+
+import numpy as np
+
+###################################################################################################
+def encode_gradients(volume):
+	"""
+	Central differences of volume [y, x, z]: int8 unit normals [3, y, x, z] (scaled by 127) and
+	uint8 magnitudes [y, x, z] (scaled by the largest one).
+	"""
+	gradient = np.stack(np.gradient(volume.astype(np.float32)))
+	magnitude = np.sqrt(np.einsum('i...,i...->...', gradient, gradient))
+	normals = np.rint(gradient / np.maximum(magnitude, 1e-6) * 127.0).astype(np.int8)
+	peak = max(float(magnitude.max()), 1e-6)
+	return normals, np.rint(magnitude * (255.0 / peak)).astype(np.uint8)
+
+class Shader(object):
+	"""
+	Blinn-Phong with a light along light (in [y, x, z] components) and the viewer looking down
+	z from the front. Lighting fades out with the gradient magnitude, homogeneous regions keep
+	their flat color.
+	"""
+	def __init__(self, ambient=0.3, diffuse=0.7, specular=0.3, shininess=16.0, light=(0.0, 0.0, -1.0)):
+		self.ambient   = ambient
+		self.diffuse   = diffuse
+		self.specular  = specular
+		self.shininess = shininess
+		self.light     = np.asarray(light, dtype=np.float32) / np.linalg.norm(light)
+		view           = np.array([0.0, 0.0, -1.0], dtype=np.float32)
+		halfway        = self.light + view
+		self.halfway   = halfway / max(np.linalg.norm(halfway), 1e-6)
+
+	def shade(self, volume, window=None):
+		"""
+		Shaded colors of the window (slices, the whole volume by default) of volume [y, x, z] in 
+		[0, 255], lit with its gradients (the colors of this renderer are the intensities). The 
+		gradients are taken on the window grown by one voxel, so its faces get central differences.
+		"""
+		window = window or tuple(slice(0, n) for n in volume.shape)
+		color_s = volume[window]
+		if not color_s.size:
+			return color_s
+		grown = tuple(slice(max(w.start - 1, 0), min(w.stop + 1, n)) for w, n in zip(window, volume.shape))
+		inner = tuple(slice(w.start - g.start, w.stop - g.start) for w, g in zip(window, grown))
+		normals, magnitude = encode_gradients(volume[grown])
+		normals, magnitude = normals[(slice(None),) + inner], magnitude[inner]
+		scale = np.float32(1.0 / 127.0)
+		# Two-sided, the normals point either way along the gradient
+		n_dot_l = np.abs(np.tensordot(self.light * scale, normals, axes=1))
+		n_dot_h = np.abs(np.tensordot(self.halfway * scale, normals, axes=1))
+		strength = magnitude * np.float32(1.0 / 255.0)
+		lit = self.ambient + self.diffuse * n_dot_l
+		shaded = color_s * (1.0 - strength + strength * lit) + strength * (255.0 * self.specular) * n_dot_h ** self.shininess
+		return np.clip(shaded, 0.0, 255.0)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Tran Minh Quan, quantm@unist.ac.kr
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# Prefetch a dataflow in worker processes through a ring of shared-memory slots.
+# Unlike PrefetchDataZMQ, the datapoints are neither pickled nor sent over a socket:
+# a worker writes the arrays straight into a free slot, the consumer gets views
+# on that slot and hands it back when it asks for the next datapoint.
+
+import itertools, mmap
+import multiprocessing as mp
+
+import numpy as np
+from six.moves import range
+
+from tensorpack.dataflow import ProxyDataFlow
+from tensorpack.utils import logger
+from tensorpack.utils.concurrency import ensure_proc_terminate, start_proc_mask_signal
+
+###################################################################################################
+ALIGNMENT = 64
+
+_WORKER_INFO = None
+
+def get_worker_info():
+	"""(index, number of workers) when called in a PrefetchDataSHM worker, None otherwise."""
+	return _WORKER_INFO
+
+def _aligned(nbytes):
+	return -(-nbytes // ALIGNMENT) * ALIGNMENT
+
+def datapoint_nbytes(dp):
+	return sum(_aligned(np.asarray(c).nbytes) for c in dp)
+
+###################################################################################################
+class _SlotWorker(mp.Process):
+	def __init__(self, ds, idx, nr_proc, arena, slot_bytes, free, ready):
+		super(_SlotWorker, self).__init__()
+		self.daemon     = True
+		self.ds         = ds
+		self.idx        = idx
+		self.nr_proc    = nr_proc
+		self.arena      = arena
+		self.slot_bytes = slot_bytes
+		self.free       = free
+		self.ready      = ready
+
+	def run(self):
+		global _WORKER_INFO
+		_WORKER_INFO = (self.idx, self.nr_proc)
+		self.ds.reset_state()
+		buf = np.frombuffer(self.arena, dtype=np.uint8)
+		warned = False
+		while True:
+			for dp in self.ds.get_data():
+				dp = [np.asarray(c) for c in dp]
+				if datapoint_nbytes(dp) > self.slot_bytes:
+					# Too big for a slot, fall back to pickling through the queue
+					if not warned:
+						logger.warn('Datapoint of {} bytes does not fit a {} bytes slot'.format(
+							datapoint_nbytes(dp), self.slot_bytes))
+						warned = True
+					self.ready.put((None, dp))
+					continue
+				slot = self.free.get()
+				offset = slot * self.slot_bytes
+				meta = []
+				for c in dp:
+					view = buf[offset:offset+c.nbytes].view(c.dtype).reshape(c.shape)
+					np.copyto(view, c)
+					meta.append((offset, c.shape, c.dtype.str))
+					offset += _aligned(c.nbytes)
+				self.ready.put((slot, meta))
+
+###################################################################################################
+class PrefetchDataSHM(ProxyDataFlow):
+	"""
+	Run ds in nr_proc processes which write the datapoints into nr_slots shared-memory slots.
+
+	The arrays yielded are views on a slot, valid until the next datapoint is requested, so
+	copy them to keep them longer (feeding them to a session copies them already).
+	Each slot holds slot_bytes; when not given, it is sized from a datapoint pulled from ds here.
+	Datapoints that do not fit are still delivered, pickled through the queue.
+	"""
+	def __init__(self, ds, nr_proc=1, nr_slots=None, slot_bytes=None):
+		super(PrefetchDataSHM, self).__init__(ds)
+		self.nr_proc    = nr_proc
+		self.nr_slots   = nr_slots or 2 * nr_proc
+		self.slot_bytes = slot_bytes
+		try:
+			self._size = ds.size()
+		except NotImplementedError:
+			self._size = -1
+		self._started = False
+
+	def _probe_slot_bytes(self):
+		self.ds.reset_state()
+		dp = next(iter(self.ds.get_data()))
+		return datapoint_nbytes(dp)
+
+	def reset_state(self):
+		if self._started:
+			return
+		self._started = True
+		if self.slot_bytes is None:
+			self.slot_bytes = self._probe_slot_bytes()
+		self.slot_bytes = _aligned(self.slot_bytes)
+		# Anonymous shared mapping, inherited by the forked workers and only touched on write
+		self.arena = mmap.mmap(-1, self.nr_slots * self.slot_bytes)
+		self.buf   = np.frombuffer(self.arena, dtype=np.uint8)
+		self.free  = mp.Queue()
+		self.ready = mp.Queue(self.nr_slots + self.nr_proc)
+		for slot in range(self.nr_slots):
+			self.free.put(slot)
+		self.procs = [_SlotWorker(self.ds, k, self.nr_proc, self.arena, self.slot_bytes, self.free, self.ready)
+					  for k in range(self.nr_proc)]
+		ensure_proc_terminate(self.procs)
+		start_proc_mask_signal(self.procs)
+		logger.info('PrefetchDataSHM: {} workers, {} slots of {:.1f} MB'.format(
+			self.nr_proc, self.nr_slots, self.slot_bytes / 2.0**20))
+
+	def _views(self, meta):
+		return [self.buf[offset:offset+int(np.prod(shape))*np.dtype(dtype).itemsize].view(dtype).reshape(shape)
+				for offset, shape, dtype in meta]
+
+	def get_data(self):
+		held = None
+		try:
+			for k in itertools.count():
+				if self._size > 0 and k >= self._size:
+					break
+				if held is not None:
+					self.free.put(held)
+					held = None
+				slot, meta = self.ready.get()
+				if slot is None:
+					yield meta
+					continue
+				held = slot
+				yield self._views(meta)
+		finally:
+			if held is not None:
+				self.free.put(held)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Tran Minh Quan, quantm@unist.ac.kr
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# Sparse volumes, for the mostly empty ones (a bucky ball fills a few percent of its 256^3 box).
+# The volume [y, x, z] is cut into bricks of BRICK^3 voxels and only the bricks holding a non-zero
+# voxel are kept, with a bitmask of the occupied bricks. Rotation resamples only the bricks the
+# content can rotate into, compositing only visits the occupied bricks, front to back.
+# Volumes with more than MAX_OCCUPANCY of their bricks occupied stay dense, see sparse_volume.
+
+import numpy as np
+
+from VolumeCompositor import apply_lut, transparent_zero, place
+
+###################################################################################################
+BRICK         = 16
+MAX_OCCUPANCY = 0.25
+
+def _bricks(volume, brick):
+	# View [gy, gx, gz, brick, brick, brick] of volume, padded with zeros to whole bricks
+	grid = tuple(-(-n // brick) for n in volume.shape)
+	pad = [(0, g * brick - n) for g, n in zip(grid, volume.shape)]
+	if any(p for _, p in pad):
+		volume = np.pad(volume, pad, mode='constant')
+	return volume.reshape(grid[0], brick, grid[1], brick, grid[2], brick).transpose(0, 2, 4, 1, 3, 5)
+
+def _overlap(start, stop, lo, hi):
+	# Slices of a brick [start, stop) and of a window [lo, hi) on their common voxels
+	a, b = max(start, lo), min(stop, hi)
+	return slice(a - start, b - start), slice(a - lo, b - lo)
+
+class SparseVolume(object):
+	"""
+	Volume of the given shape [y, x, z] kept as the occupied bricks [n, brick, brick, brick] at the
+	brick coordinates coords [n, 3], sorted front to back (along z). mask is the occupancy of the
+	grid of bricks, packed 8 bricks per byte.
+	"""
+	def __init__(self, shape, coords, bricks, brick=BRICK):
+		self.shape  = tuple(shape)
+		self.brick  = brick
+		self.grid   = tuple(-(-n // brick) for n in self.shape)
+		coords      = np.asarray(coords, dtype=np.int32).reshape(-1, 3)
+		order       = np.lexsort((coords[:, 1], coords[:, 0], coords[:, 2]))
+		self.coords = coords[order]
+		self.bricks = bricks[order]
+		occupancy   = np.zeros(self.grid, dtype=bool)
+		occupancy[tuple(self.coords.T)] = True
+		self.mask   = np.packbits(occupancy)
+
+	@classmethod
+	def from_dense(cls, volume, brick=BRICK):
+		return sparse_volume(volume, brick, max_occupancy=1.0)
+
+	@property
+	def occupancy(self):
+		"""Boolean grid of the occupied bricks."""
+		return np.unpackbits(self.mask)[:int(np.prod(self.grid))].reshape(self.grid).astype(bool)
+
+	@property
+	def fraction(self):
+		return len(self.coords) / float(np.prod(self.grid))
+
+	def to_dense(self, dtype=None):
+		volume = np.zeros(tuple(g * self.brick for g in self.grid), dtype=dtype or self.bricks.dtype)
+		b = self.brick
+		volume.reshape(self.grid[0], b, self.grid[1], b, self.grid[2], b).transpose(0, 2, 4, 1, 3, 5)[tuple(self.coords.T)] = self.bricks
+		return volume[:self.shape[0], :self.shape[1], :self.shape[2]]
+
+	def read(self, lo, hi):
+		"""Dense voxels of the window [lo, hi) (one bound per axis), assembled from the occupied bricks."""
+		b = self.brick
+		window = np.zeros([h - l for l, h in zip(lo, hi)], dtype=self.bricks.dtype)
+		first, last = np.array(lo) // b, -(-np.array(hi) // b)
+		inside = np.all((self.coords >= first) & (self.coords < last), axis=1)
+		for index, voxels in zip(self.coords[inside], self.bricks[inside]):
+			pairs = [_overlap(k * b, k * b + b, l, h) for k, l, h in zip(index, lo, hi)]
+			window[tuple(w for _, w in pairs)] = voxels[tuple(s for s, _ in pairs)]
+		return window
+
+	def rotate(self, degrees, order=3, margin=None):
+		"""
+		The volume rotated by degrees in the plane of x and z like VolumeCompositor.rotate_content
+		(scipy.ndimage.rotate with reshape=False, clipped to [0, 255]), as a float32 SparseVolume.
+		Only the bricks within margin voxels of the rotated occupied bricks are resampled, each one
+		from the occupied bricks around its preimage. margin covers the ringing of the spline, which
+		is cut below 1e-2 of an intensity level by the default.
+		"""
+		import scipy.ndimage
+		b = self.brick
+		margin = margin if margin is not None else (8 if order > 1 else 1)
+		c, s = np.cos(np.deg2rad(degrees)), np.sin(np.deg2rad(degrees))
+		rotation = np.array([[c, s], [-s, c]]) # Output to input (x, z), as in scipy.ndimage.rotate
+		center = (np.array(self.shape[1:], dtype=np.float64) - 1) / 2.0
+
+		# Bricks the occupied ones rotate into
+		targets = np.zeros(self.grid, dtype=bool)
+		for i, j, k in self.coords:
+			corners = np.array([[x, z] for x in (j * b - 1, j * b + b) for z in (k * b - 1, k * b + b)], dtype=np.float64)
+			moved = (corners - center).dot(rotation) + center # Input to output, rotation is orthogonal
+			lo = np.maximum((np.floor(moved.min(axis=0)) - margin) // b, 0).astype(int)
+			hi = np.minimum((np.ceil(moved.max(axis=0)) + margin) // b + 1, self.grid[1:]).astype(int)
+			targets[i, lo[0]:hi[0], lo[1]:hi[1]] = True
+
+		coords, bricks = [], []
+		for index in np.argwhere(targets):
+			ys, xs, zs = [np.arange(k * b, min(k * b + b, n)) for k, n in zip(index, self.shape)]
+			xx, zz = np.meshgrid(xs - center[0], zs - center[1], indexing='ij')
+			source_x = rotation[0, 0] * xx + rotation[0, 1] * zz + center[0]
+			source_z = rotation[1, 0] * xx + rotation[1, 1] * zz + center[1]
+			# The window of the preimage, cut at the volume like the dense rotation
+			lo = [ys[0], max(int(np.floor(source_x.min())) - margin, 0), max(int(np.floor(source_z.min())) - margin, 0)]
+			hi = [ys[-1] + 1, min(int(np.ceil(source_x.max())) + margin + 1, self.shape[1]),
+				  min(int(np.ceil(source_z.max())) + margin + 1, self.shape[2])]
+			if hi[1] <= lo[1] or hi[2] <= lo[2]:
+				continue
+			window = self.read(lo, hi).astype(np.float32)
+			if not window.any():
+				continue
+			points = np.stack([np.broadcast_to(ys[:, None, None] - lo[0], (len(ys),) + xx.shape),
+							   np.broadcast_to(source_x - lo[1], (len(ys),) + xx.shape),
+							   np.broadcast_to(source_z - lo[2], (len(ys),) + xx.shape)])
+			voxels = np.clip(scipy.ndimage.map_coordinates(window, points, order=order, mode='constant'), 0.0, 255.0)
+			if voxels.any():
+				padded = np.zeros((b, b, b), dtype=np.float32)
+				padded[:voxels.shape[0], :voxels.shape[1], :voxels.shape[2]] = voxels
+				coords.append(index)
+				bricks.append(padded)
+		bricks = np.stack(bricks) if bricks else np.zeros((0, b, b, b), dtype=np.float32)
+		return SparseVolume(self.shape, coords, bricks, b)
+
+	def composite(self, lut):
+		"""
+		VolumeCompositor.over of the volume along z through lut [256] (or a stack [K, 256]), front to
+		back over the occupied bricks only, which needs intensity 0 to be transparent. Tiles whose
+		rays are already opaque are skipped. Returns color and alpha [y, x] (or [K, y, x]) in [0, 1].
+		"""
+		assert transparent_zero(lut), 'Empty bricks are only skipped when intensity 0 is transparent'
+		b = self.brick
+		dimy, dimx, dimz = self.shape
+		color = np.zeros(lut.shape[:-1] + (dimy, dimx), dtype=np.float32)
+		alpha = np.zeros(lut.shape[:-1] + (dimy, dimx), dtype=np.float32)
+		transmittance = np.ones(lut.shape[:-1] + (dimy, dimx), dtype=np.float32)
+		for (i, j, k), voxels in zip(self.coords, self.bricks):
+			ys, xs = slice(i * b, min(i * b + b, dimy)), slice(j * b, min(j * b + b, dimx))
+			t = transmittance[..., ys, xs]
+			if not t.any():
+				continue
+			voxels = voxels[:ys.stop - ys.start, :xs.stop - xs.start, :min(b, dimz - k * b)]
+			color_s = voxels / 255.0
+			alpha_s = apply_lut(lut, voxels) / 255.0
+			c, a = color[..., ys, xs], alpha[..., ys, xs]
+			# Co += To * Cs[z], Ao += To * As[z], To *= 1 - As[z]
+			for z in range(voxels.shape[-1]):
+				c += t * color_s[..., z]
+				a += t * alpha_s[..., z]
+				t *= 1 - alpha_s[..., z]
+		return color, alpha
+
+def sparse_volume(volume, brick=BRICK, max_occupancy=MAX_OCCUPANCY, shape=None, offset=(0, 0, 0), box=None):
+	"""
+	SparseVolume of volume [y, x, z] sitting at offset in a frame of zeros of shape (its own shape
+	by default), or volume itself when more than max_occupancy of the bricks of the frame are
+	occupied. Only the bricks around the content box [(lo, hi)] in the frame (the whole volume by
+	default) are cut, the frame is never allocated.
+	"""
+	shape = tuple(shape or volume.shape)
+	box = box or [(o, o + n) for o, n in zip(offset, volume.shape)]
+	if any(lo >= hi for lo, hi in box):
+		return SparseVolume(shape, np.zeros((0, 3), dtype=np.int32), np.zeros((0, brick, brick, brick), dtype=np.float32), brick)
+	first = [max(lo, 0) // brick for lo, _ in box]
+	window = tuple(slice(k * brick, min(-(-hi // brick) * brick, n)) for k, (_, hi), n in zip(first, box, shape))
+	bricks = _bricks(place(volume, offset, window), brick)
+	occupied = bricks.any(axis=(3, 4, 5))
+	if np.count_nonzero(occupied) > max_occupancy * np.prod([-(-n // brick) for n in shape]):
+		return volume
+	return SparseVolume(shape, np.argwhere(occupied) + first, bricks[occupied], brick)
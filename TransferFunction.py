@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Tran Minh Quan, quantm@unist.ac.kr
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# A bank of transfer functions compiled once into a single [K, 256] array and memory-mapped,
+# so every training sample can draw its own LUT without parsing any transfer function file.
+
+import os, glob
+
+import numpy as np
+from natsort import natsorted
+
+###################################################################################################
+BANK_NAME = 'lut_bank.npy'
+
+def parse_transfer_function(path):
+	"""
+	One LUT [256] of alphas in [0, 255] from path:
+	  .npy          256 alphas already sampled
+	  anything else text rows of control points 'intensity ... alpha', e.g. the
+	                [intensity, r, g, b, alpha] points given to VolumeSampler.VolumeRender,
+	                alpha in [0, 1], linearly interpolated in between
+	"""
+	if path.endswith('.npy'):
+		lut = np.load(path).astype(np.float32).reshape(-1)
+		assert lut.size == 256, '{} does not hold 256 entries'.format(path)
+		return lut
+	points = np.atleast_2d(np.loadtxt(path, dtype=np.float32))
+	points = points[np.argsort(points[:, 0])]
+	return 255.0 * np.interp(np.arange(256), points[:, 0], points[:, -1]).astype(np.float32)
+
+def rgba_lut(points):
+	"""[256, 4] RGBA in [0, 1] from control points [intensity, r, g, b, alpha] (all but intensity in [0, 1])."""
+	points = np.atleast_2d(np.asarray(points, dtype=np.float32))
+	points = points[np.argsort(points[:, 0])]
+	return np.stack([np.interp(np.arange(256), points[:, 0], points[:, k]) for k in range(1, 5)], axis=-1).astype(np.float32)
+
+def parse_rgba_transfer_function(path):
+	"""(control points, [256, 4] RGBA lut) of a text file of rows 'intensity r g b alpha', as VolumeRender takes them."""
+	points = np.atleast_2d(np.loadtxt(path, dtype=np.float32))
+	assert points.shape[1] == 5, '{}: rows are intensity r g b alpha'.format(path)
+	return points, rgba_lut(points)
+
+def build_lut_bank(paths, output):
+	"""Compile the transfer functions of paths into one float32 [K, 256] bank at output."""
+	bank = np.stack([parse_transfer_function(path) for path in paths]).astype(np.float32)
+	np.save(output, bank)
+	return bank
+
+###################################################################################################
+class LUTBank(object):
+	"""
+	path is either a compiled bank (.npy [K, 256], uint8 or float32) or a directory of
+	transfer function files, compiled into path/lut_bank.npy the first time and whenever
+	one of them is newer than the bank.
+	"""
+	def __init__(self, path):
+		if os.path.isdir(path):
+			sources = [f for f in natsorted(glob.glob(os.path.join(path, '*.*')))
+					   if os.path.basename(f) != BANK_NAME]
+			assert sources, 'No transfer function in {}'.format(path)
+			bank = os.path.join(path, BANK_NAME)
+			if not os.path.exists(bank) or os.path.getmtime(bank) < max(os.path.getmtime(f) for f in sources):
+				build_lut_bank(sources, bank)
+			path = bank
+		self.path = path
+		self.luts = np.load(path, mmap_mode='r') # Shared by the forked workers through the page cache
+		assert self.luts.ndim == 2 and self.luts.shape[1] == 256, self.luts.shape
+
+	def __len__(self):
+		return len(self.luts)
+
+	def __getitem__(self, index):
+		return np.asarray(self.luts[index], dtype=np.float32)
+
+	def sample(self, rng):
+		"""(index, lut [256] float32) drawn with the generator rng."""
+		index = int(rng.integers(0, len(self.luts)))
+		return index, self[index]
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Tran Minh Quan, quantm@unist.ac.kr
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# Host compositing of volumes, in memory or streamed from a lazy volume (see VolumeReader)
+# with the memory bounded by one slab.
+
+import numpy as np
+
+from VolumeReader import ArrayVolume
+
+###################################################################################################
+def over(color_s, alpha_s, color=None, alpha=None):
+	"""
+	Over operator, back to front along the last axis of color_s and alpha_s [..., z] in [0, 255],
+	onto color and alpha [...] in [0, 1], what lies behind the slices (nothing by default).
+	alpha_s may hold K transfer functions [K, ..., z] of the same color_s (see apply_lut), the
+	colors are then read once per slice for all of them and the results are [K, ...].
+	Compositing algorithm formula is from slide 23 of
+	http://www.seas.upenn.edu/~cis565/LECTURES/VolumeRendering.pdf
+	"""
+	if color is None:
+		color = np.zeros(alpha_s.shape[:-1], dtype=np.float32)
+		alpha = np.zeros(alpha_s.shape[:-1], dtype=np.float32)
+	# Co[z] = Cs[z] + (1 - As[z]*Co[z+1]
+	# Ao[z] = As[z] + (1 - As[z]*Ao[z+1]
+	for z in range(color_s.shape[-1]-1, -1, -1):
+		color = color_s[...,z]/255.0 + (1-alpha_s[...,z]/255.0) * color
+		alpha = alpha_s[...,z]/255.0 + (1-alpha_s[...,z]/255.0) * alpha
+	return color, alpha
+
+###################################################################################################
+# Fixed point
+#
+# The over operator on uint8 slices without converting them to float. 1.0 is FIXED_ONE = 255*257,
+# so an intensity or alpha c/255 is exactly c*257. The transmittance 1 - a/255 is read from a table
+# indexed by a in units of 2^-FIXED_SHIFT, the products are uint64, the accumulators uint32.
+# The color is not premultiplied and grows past 1.0, up to depth*FIXED_ONE.
+FIXED_ONE   = 65535
+FIXED_SHIFT = 24
+
+_FIXED_VALUE         = np.arange(256, dtype=np.uint32) * 257
+_FIXED_TRANSMITTANCE = np.rint((255 - np.arange(256)) * (2.0 ** FIXED_SHIFT / 255.0)).astype(np.uint64)
+
+def over_fixed(color_s, alpha_s):
+	"""
+	over of uint8 color_s [..., z] and alpha_s [..., z] (or [K, ..., z]) in integer arithmetic.
+	Returns color and alpha in [0, 1] as float32, within fixed_error_bound of over.
+	"""
+	assert color_s.dtype == np.uint8 and alpha_s.dtype == np.uint8, (color_s.dtype, alpha_s.dtype)
+	assert color_s.shape[-1] < 2 ** 16, 'The color accumulator holds 2^16 opaque white slices'
+	color = np.zeros(alpha_s.shape[:-1], dtype=np.uint32)
+	alpha = np.zeros(alpha_s.shape[:-1], dtype=np.uint32)
+	half, shift = np.uint64(1 << (FIXED_SHIFT - 1)), np.uint64(FIXED_SHIFT)
+	for z in range(color_s.shape[-1]-1, -1, -1):
+		a = alpha_s[..., z]
+		transmittance = _FIXED_TRANSMITTANCE[a]
+		color = ((color * transmittance + half) >> shift).astype(np.uint32) + _FIXED_VALUE[color_s[..., z]]
+		alpha = ((alpha * transmittance + half) >> shift).astype(np.uint32) + _FIXED_VALUE[a]
+	return (color / float(FIXED_ONE)).astype(np.float32), (alpha / float(FIXED_ONE)).astype(np.float32)
+
+def fixed_error_bound(depth):
+	"""
+	(color, alpha) bounds of the difference between over_fixed and over in [0, 1], for rays of depth
+	slices. Every slice rounds the product by half a unit and the transmittance table by 2^-(shift+1)
+	of the accumulator, which is at most the number of slices composited so far. The float32 result
+	rounds by 2^-24 of itself, at most depth for the color and 1 for the alpha.
+	"""
+	table = 2.0 ** -(FIXED_SHIFT + 1) * FIXED_ONE
+	alpha = depth * (0.5 + table)
+	color = depth * 0.5 + table * depth * (depth + 1) / 2.0
+	return color / FIXED_ONE + depth * 2.0 ** -24, alpha / FIXED_ONE + 2.0 ** -24
+
+def check_fixed(color_s, alpha_s):
+	"""(color error, alpha error, color bound, alpha bound) of over_fixed against over in float64."""
+	color, alpha = over_fixed(color_s, alpha_s)
+	reference = over(color_s.astype(np.float64), alpha_s.astype(np.float64))
+	bounds = fixed_error_bound(color_s.shape[-1])
+	errors = [float(np.abs(fixed - exact).max()) if fixed.size else 0.0 for fixed, exact in zip((color, alpha), reference)]
+	return tuple(errors) + bounds
+
+def verify_fixed(seed=0, shape=(16, 16)):
+	"""
+	Assert that over_fixed is within fixed_error_bound of over on random uint8 slabs of several
+	depths up to 256 and past it, and on all opaque and all transparent slabs.
+	"""
+	rng = np.random.RandomState(seed)
+	slabs = []
+	for depth in (1, 2, 16, 255, 256, 257):
+		slabs.append((rng.randint(0, 256, shape + (depth,)), rng.randint(0, 256, shape + (depth,))))
+	for depth in (1, 256):
+		colors = rng.randint(0, 256, shape + (depth,))
+		slabs.append((colors, np.full(shape + (depth,), 255))) # Opaque, only the front slice shows
+		slabs.append((colors, np.zeros(shape + (depth,))))    # Transparent, the colors add up
+		slabs.append((np.full(shape + (depth,), 255), np.zeros(shape + (depth,)))) # The largest color
+	for color_s, alpha_s in slabs:
+		color_error, alpha_error, color_bound, alpha_bound = check_fixed(color_s.astype(np.uint8), alpha_s.astype(np.uint8))
+		assert color_error <= color_bound and alpha_error <= alpha_bound, \
+			'over_fixed is off its bound at depth {}: color {} > {} or alpha {} > {}'.format(
+				color_s.shape[-1], color_error, color_bound, alpha_error, alpha_bound)
+
+###################################################################################################
+# Color
+def gray_to_rgb(gray):
+	"""[..., 3] read-only view of gray [...] repeated over the channels, nothing is copied."""
+	return np.broadcast_to(gray[..., None], gray.shape + (3,))
+
+def premultiply(lut):
+	# RGBA lut [256, 4] in [0, 1] with the colors multiplied by their alpha
+	lut = np.array(lut, dtype=np.float32)
+	lut[:, :3] *= lut[:, 3:]
+	return lut
+
+def over_rgba(intensities, lut, out=None):
+	"""
+	Over operator with premultiplied colors, back to front along the last axis of intensities
+	[..., z] in [0, 255], through the RGBA lut [256, 4] in [0, 1]. Composited in place into out
+	[..., 3] float32, what lies behind the slices (zeros by default), which is returned.
+	"""
+	lut = premultiply(lut)
+	if out is None:
+		out = np.zeros(intensities.shape[:-1] + (3,), dtype=np.float32)
+	transmittance = np.empty(intensities.shape[:-1] + (1,), dtype=np.float32)
+	for z in range(intensities.shape[-1]-1, -1, -1):
+		sample = lut[intensities[..., z].astype(np.uint8)] # [..., 4]
+		np.subtract(1.0, sample[..., 3:], out=transmittance)
+		out *= transmittance
+		out += sample[..., :3]
+	return out
+
+###################################################################################################
+# Intensity projections
+#
+# Maximum (mip), minimum (minip) and average intensity along the rays, one reduction per slab
+# instead of the sequential over operator. Voxels outside a window of the ray are 0.
+PROJECTION_MODES = ['over', 'mip', 'minip', 'average']
+
+def _accumulate(mode, result, color_s):
+	# Fold the slices color_s [..., z] into the partial reduction result (None at first)
+	if color_s.shape[-1] == 0:
+		return result
+	if mode == 'average':
+		part = color_s.sum(axis=-1, dtype=np.float32)
+		return part if result is None else result + part
+	part = color_s.max(axis=-1) if mode == 'mip' else color_s.min(axis=-1)
+	if result is None:
+		return part.astype(np.float32)
+	return np.maximum(result, part) if mode == 'mip' else np.minimum(result, part)
+
+def _finish(mode, result, shape, length, depth):
+	# Intensity in [0, 1] from the reduction of length slices out of a ray of depth voxels
+	if result is None:
+		return np.zeros(shape, dtype=np.float32)
+	if mode == 'average':
+		result = result / float(depth)
+	elif mode == 'minip' and length < depth:
+		result = np.minimum(result, 0.0) # The voxels left out are 0
+	return (result / 255.0).astype(np.float32)
+
+def project_intensity(color_s, mode, depth=None, slab=32):
+	"""
+	mip, minip or average intensity of color_s [..., z] in [0, 255] along z, in [0, 1], reduced
+	slab slices at a time. depth is the length of the whole ray when color_s is a window of it.
+	"""
+	assert mode in PROJECTION_MODES[1:], mode
+	depth = depth or color_s.shape[-1]
+	result = None
+	for z0 in range(0, color_s.shape[-1], slab):
+		result = _accumulate(mode, result, color_s[..., z0:z0 + slab])
+	return _finish(mode, result, color_s.shape[:-1], color_s.shape[-1], depth)
+
+def apply_lut(lut, intensities):
+	"""Alphas of intensities [...] under lut [256], or under a stack of K luts [K, 256] as [K, ...], in one gather."""
+	return np.take(lut, intensities.astype(np.uint8), axis=-1)
+
+def transparent_zero(lut):
+	# Whether intensity 0 is transparent under every transfer function of lut
+	return bool(np.all(np.take(lut, 0, axis=-1) == 0))
+
+def _lazy(volume):
+	return ArrayVolume(volume) if isinstance(volume, np.ndarray) else volume
+
+def composite_volume(volume, lut, depth=32, box=None, mode='over', zs=slice(None)):
+	"""
+	Projection along z of the slices zs of volume [z, y, x] (an array or a lazy volume) through
+	the transfer function lut, marching slab by slab from the back. With the content box (see 
+	VolumeIndex) only the box is read and the projection is padded around it. mode is one of PROJECTION_MODES,
+	the intensity projections return the transfer function of the projected intensity as alpha.
+	A stack of K luts [K, 256] composites all of them in the one pass, see over.
+	Returns color and alpha [y, x] (or [K, y, x]) in [0, 1].
+	"""
+	assert mode in PROJECTION_MODES, mode
+	volume = _lazy(volume)
+	color = np.zeros(lut.shape[:-1] + volume.shape[1:], dtype=np.float32)
+	alpha = np.zeros(lut.shape[:-1] + volume.shape[1:], dtype=np.float32)
+	if box is None or (mode == 'over' and not transparent_zero(lut)):
+		box = [(0, n) for n in volume.shape]
+	first, last = zs.indices(volume.shape[0])[:2]
+	(z0, z1), (y0, y1), (x0, x1) = box
+	z0, z1 = max(z0, first), max(min(z1, last), max(z0, first))
+	c, a = color[..., y0:y1, x0:x1], alpha[..., y0:y1, x0:x1]
+	starts = list(range(z0, z1, depth))
+	result = None
+	for start in reversed(starts):
+		slab = np.transpose(volume.read(z=slice(start, min(start + depth, z1)), y=slice(y0, y1), x=slice(x0, x1)), [1, 2, 0])
+		if mode == 'over':
+			c, a = over(slab.astype(np.float32), apply_lut(lut, slab), c, a)
+		else:
+			result = _accumulate(mode, result, slab)
+	if mode != 'over':
+		c = _finish(mode, result, c.shape, z1 - z0, max(last - first, 1))
+		a = apply_lut(lut, np.rint(c * 255.0)) / 255.0
+	color[..., y0:y1, x0:x1], alpha[..., y0:y1, x0:x1] = c, a
+	return color, alpha
+
+###################################################################################################
+# Content windows
+#
+# Voxels of intensity 0 add nothing to the over operator as long as lut[0] == 0 (the color is not
+# premultiplied, so any non-zero intensity counts, whatever its alpha). Rotation, compositing and
+# ray casting can then skip everything outside the bounding box of the non-zero voxels.
+def rotation_window(box, shape, margin=2):
+	"""
+	Slices of volume [y, x, z] holding the content box [(y0, y1), (x0, x1), (z0, z1)] under
+	any rotation in the plane of x and z about the center. The x and z windows are centered,
+	so rotating the window about its own center is rotating the volume; margin covers the
+	support of the spline.
+	"""
+	(y0, y1), (x0, x1), (z0, z1) = box
+	if y0 >= y1 or x0 >= x1 or z0 >= z1:
+		return (slice(0, 0),) * 3 # Nothing to rotate
+	cx, cz = (shape[1] - 1) / 2.0, (shape[2] - 1) / 2.0
+	radius = max(np.hypot(x - cx, z - cz) for x in (x0, x1 - 1) for z in (z0, z1 - 1)) + margin
+	sx = int(max(0, np.floor(cx - radius)))
+	sz = int(max(0, np.floor(cz - radius)))
+	return (slice(y0, y1), slice(sx, shape[1] - sx), slice(sz, shape[2] - sz))
+
+def place(volume, offset, window):
+	"""float32 window (slices) of a frame of zeros holding volume at offset, only the window is allocated."""
+	out = np.zeros([w.stop - w.start for w in window], dtype=np.float32)
+	src, dst = [], []
+	for w, o, n in zip(window, offset, volume.shape):
+		a, b = max(w.start, o), min(w.stop, o + n)
+		src.append(slice(a - o, max(b, a) - o))
+		dst.append(slice(a - w.start, max(b, a) - w.start))
+	out[tuple(dst)] = volume[tuple(src)]
+	return out
+
+def rotate_content(volume, degrees, box=None, order=3, shape=None, offset=(0, 0, 0)):
+	"""
+	volume [y, x, z] rotated by degrees in the plane of x and z like scipy.ndimage.rotate with
+	reshape=False, clipped to [0, 255]. The volume sits at offset in a frame of zeros of shape
+	(its own shape by default), which is what rotates. Only the rotation_window of the content
+	box (in the frame) is padded and resampled, box None is the whole frame. Returns the rotated
+	frame and the window.
+	"""
+	import scipy.ndimage
+	shape = tuple(shape or volume.shape)
+	window = rotation_window(box, shape) if box else tuple(slice(0, n) for n in shape)
+	rotated = np.zeros(shape, dtype=np.float32)
+	content = place(volume, offset, window)
+	if content.size:
+		rotated[window] = np.clip(scipy.ndimage.rotate(content, angle=degrees, axes=(1, 2), reshape=False, 
+													   order=order, mode='constant'), 0.0, 255.0)
+	return rotated, window
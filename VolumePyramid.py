@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Tran Minh Quan, quantm@unist.ac.kr
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# Multi-resolution pyramid of a volume, level k is 2^k times smaller along every axis.
+# The levels are built once, slab by slab, and stored as .npy files next to the volume, in a
+# hidden directory so the listings of the volumes do not pick them up (or under a cache directory,
+# see VolumeReader.cache_location):
+#   volume.tif
+#   .volume.tif.box/level1.npy, level2.npy, ...
+# so low-resolution training stages read a fraction of the voxels, at the level of their resolution.
+# Levels that cannot be written are built in memory.
+
+import os, math, threading
+
+import numpy as np
+
+from VolumeReader import ArrayVolume, open_volume, read_window, cache_location
+
+###################################################################################################
+PYRAMID_MODES = ['box', 'max']
+
+def downsample2(volume, mode='box'):
+	"""Halve volume [z, y, x] along every axis, odd sides are padded with zeros."""
+	pad = [(0, n % 2) for n in volume.shape]
+	if any(p for _, p in pad):
+		volume = np.pad(volume, pad, mode='constant')
+	dimz, dimy, dimx = volume.shape
+	blocks = volume.reshape(dimz // 2, 2, dimy // 2, 2, dimx // 2, 2)
+	if mode == 'max':
+		return blocks.max(axis=(1, 3, 5))
+	mean = blocks.mean(axis=(1, 3, 5), dtype=np.float32)
+	return np.rint(mean).astype(volume.dtype) if volume.dtype.kind in 'ui' else mean.astype(volume.dtype)
+
+class VolumePyramid(object):
+	"""
+	Levels of the volume at path down to min_size voxels along the shortest axis. Missing or
+	stale levels (older than the volume) are built when the pyramid is opened.
+	"""
+	def __init__(self, path, mode='box', min_size=16, slab=64, cache_dir=None):
+		assert mode in PYRAMID_MODES
+		self.path = path
+		self.mode = mode
+		head, tail = os.path.split(path.rstrip(os.sep))
+		self.directory = cache_location(os.path.join(head, '.{}.{}'.format(tail, mode)), cache_dir)
+		self.levels = [open_volume(path)]
+		nr_levels = max(int(math.log(max(min(self.levels[0].shape), 1) / float(min_size), 2)) + 1, 1)
+		for level in range(1, nr_levels):
+			filename = os.path.join(self.directory, 'level{}.npy'.format(level))
+			if not os.path.exists(filename) or os.path.getmtime(filename) < os.path.getmtime(path):
+				self.levels.append(ArrayVolume(self.build(level, filename, slab)))
+			else:
+				self.levels.append(ArrayVolume(np.load(filename, mmap_mode='r')))
+
+	def build(self, level, filename, slab):
+		# Halve the level above slab by slab (slab is even) into a memory-mapped file, or into 
+		# memory when it cannot be written
+		source = self.levels[level-1]
+		shape = tuple(-(-n // 2) for n in source.shape)
+		temporary = '{}.{}.{}.tmp.npy'.format(filename[:-4], os.getpid(), threading.current_thread().ident)
+		try:
+			if not os.path.isdir(self.directory):
+				os.makedirs(self.directory)
+			out = np.lib.format.open_memmap(temporary, mode='w+', dtype=source.dtype, shape=shape)
+		except (IOError, OSError):
+			out, temporary = np.empty(shape, dtype=source.dtype), None
+		for z0 in range(0, source.shape[0], slab):
+			out[z0 // 2:(z0 + slab) // 2] = downsample2(source.read(z=slice(z0, z0 + slab)), self.mode)
+		if temporary is None:
+			return out
+		out.flush()
+		del out
+		os.rename(temporary, filename) # Atomic, concurrent builders do not see partial levels
+		return np.load(filename, mmap_mode='r')
+
+	def __len__(self):
+		return len(self.levels)
+
+	def __getitem__(self, level):
+		if not 0 <= level < len(self.levels):
+			raise IndexError('{} has levels 0 to {}, not {}'.format(self.path, len(self.levels)-1, level))
+		return self.levels[level]
+
+_PYRAMIDS = {}
+
+def open_pyramid(path, mode='box', cache_dir=None):
+	"""VolumePyramid of path, opened once per process."""
+	key = (path, mode, cache_dir)
+	if key not in _PYRAMIDS:
+		_PYRAMIDS[key] = VolumePyramid(path, mode, cache_dir=cache_dir)
+	return _PYRAMIDS[key]
+
+def read_level(path, level, shape, crop=(0.5, 0.5, 0.5), mode='box', cache_dir=None):
+	"""VolumeReader.read_volume at the given level of the pyramid of path."""
+	return read_window(open_pyramid(path, mode, cache_dir)[level], shape, crop)
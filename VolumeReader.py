@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Author: Tran Minh Quan, quantm@unist.ac.kr
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# Lazy access to volumes larger than memory.
+# A volume is opened without reading its voxels, read(z, y, x) then decodes only what the
+# slices cover: one TIFF page at a time, or only the chunks of a chunked directory.
+#
+# Chunked directory layout (Zarr-like):
+#   meta.json      {"shape": [z, y, x], "dtype": "uint8", "chunks": [cz, cy, cx]}
+#   i.j.k.npy      chunk (i, j, k) of the chunk grid, missing chunks read as zeros
+
+import os, json, threading, contextlib
+
+import numpy as np
+
+###################################################################################################
+def _bounds(index, size):
+	start, stop, step = index.indices(size)
+	assert step == 1, 'Only contiguous reads'
+	return start, max(stop, start)
+
+class ArrayVolume(object):
+	"""An in-memory array behind the read interface of the lazy volumes."""
+	def __init__(self, array):
+		self.array = array
+		self.shape = array.shape
+		self.dtype = array.dtype
+
+	def read(self, z=slice(None), y=slice(None), x=slice(None)):
+		return np.asarray(self.array[z, y, x])
+
+	def close(self):
+		pass
+
+class TiffVolume(object):
+	"""
+	Multi-page TIFF, one 2D page per slice. The file stays open (reopened after a fork) and a
+	read only decodes the strips or tiles of each page covering its rows and columns.
+	"""
+	def __init__(self, path):
+		self.path = path
+		self.lock = threading.Lock()
+		self._open()
+		page = self.tif.pages[0]
+		assert len(page.shape) == 2, '{}: pages are not 2D slices'.format(path)
+		self.shape = (len(self.tif.pages),) + tuple(page.shape)
+		self.dtype = np.dtype(page.dtype)
+
+	def _open(self):
+		import tifffile
+		self.pid = os.getpid()
+		self.tif = tifffile.TiffFile(self.path)
+
+	def close(self):
+		self.tif.close()
+
+	def read_page(self, page, y0, y1, x0, x1):
+		"""page[y0:y1, x0:x1], reading the rows of an uncompressed page or decoding the segments (strips or tiles) it covers."""
+		handle = self.tif.filehandle
+		contiguous = getattr(page, 'is_contiguous', None)
+		if contiguous:
+			width = page.imagewidth
+			handle.seek(contiguous[0] + y0 * width * self.dtype.itemsize)
+			data = handle.read((y1-y0) * width * self.dtype.itemsize)
+			rows = np.frombuffer(data, dtype=self.dtype.newbyteorder(self.tif.byteorder))
+			return rows.reshape(y1-y0, width)[:, x0:x1]
+		decode = getattr(page, 'decode', None)
+		if not callable(decode) or len(page.dataoffsets) == 1:
+			return page.asarray()[y0:y1, x0:x1] # One segment, or a tifffile without segment decoding
+		if page.is_tiled:
+			height, width = page.tilelength, page.tilewidth
+		else:
+			height, width = page.rowsperstrip, page.imagewidth
+		across = -(-page.imagewidth // width)
+		out = np.zeros((y1-y0, x1-x0), dtype=self.dtype)
+		for r in range(y0 // height, -(-y1 // height)):
+			for c in range(x0 // width, -(-x1 // width)):
+				index = r * across + c
+				if not page.databytecounts[index]:
+					continue # Missing segments read as zeros
+				handle.seek(page.dataoffsets[index])
+				data = handle.read(page.databytecounts[index])
+				segment = decode(data, index, jpegtables=page.jpegtables)[0]
+				segment = segment.reshape(segment.shape[-3:-1]) # [rows, columns] of the strip or tile
+				a, b = max(r * height, y0), min(r * height + segment.shape[0], y1)
+				d, e = max(c * width, x0), min(c * width + segment.shape[1], x1)
+				out[a-y0:b-y0, d-x0:e-x0] = segment[a - r * height:b - r * height, d - c * width:e - c * width]
+		return out
+
+	def read(self, z=slice(None), y=slice(None), x=slice(None)):
+		z0, z1 = _bounds(z, self.shape[0])
+		y0, y1 = _bounds(y, self.shape[1])
+		x0, x1 = _bounds(x, self.shape[2])
+		out = np.empty((z1-z0, y1-y0, x1-x0), dtype=self.dtype)
+		with self.lock: # One file position for the threads of the reader
+			if self.pid != os.getpid():
+				self._open() # The position of an inherited handle is shared with the parent
+			for k in range(z0, z1):
+				out[k-z0] = self.read_page(self.tif.pages[k], y0, y1, x0, x1)
+		return out
+
+class ChunkedVolume(object):
+	"""Directory of chunks, see the layout above. The chunks are memory-mapped."""
+	def __init__(self, path):
+		with open(os.path.join(path, 'meta.json')) as f:
+			meta = json.load(f)
+		self.path   = path
+		self.shape  = tuple(meta['shape'])
+		self.dtype  = np.dtype(meta['dtype'])
+		self.chunks = tuple(meta['chunks'])
+
+	def close(self):
+		pass
+
+	def chunk_path(self, i, j, k):
+		return os.path.join(self.path, '{}.{}.{}.npy'.format(i, j, k))
+
+	def read(self, z=slice(None), y=slice(None), x=slice(None)):
+		bounds = [_bounds(s, n) for s, n in zip((z, y, x), self.shape)]
+		out = np.zeros([b1-b0 for b0, b1 in bounds], dtype=self.dtype)
+		grids = [range(b0 // c, -(-b1 // c)) for (b0, b1), c in zip(bounds, self.chunks)]
+		for i in grids[0]:
+			for j in grids[1]:
+				for k in grids[2]:
+					path = self.chunk_path(i, j, k)
+					if not os.path.exists(path):
+						continue
+					chunk = np.load(path, mmap_mode='r')
+					src, dst = [], []
+					for axis, index in enumerate((i, j, k)):
+						origin = index * self.chunks[axis]
+						lo = max(bounds[axis][0], origin)
+						hi = min(bounds[axis][1], origin + chunk.shape[axis])
+						src.append(slice(lo - origin, hi - origin))
+						dst.append(slice(lo - bounds[axis][0], hi - bounds[axis][0]))
+					out[tuple(dst)] = chunk[tuple(src)]
+		return out
+
+def write_chunked(volume, path, chunks=(64, 64, 64)):
+	"""Store volume (an array or a lazy volume) as a chunked directory, one z slab of chunks at a time."""
+	if isinstance(volume, np.ndarray):
+		volume = ArrayVolume(volume)
+	if not os.path.isdir(path):
+		os.makedirs(path)
+	for i, z0 in enumerate(range(0, volume.shape[0], chunks[0])):
+		slab = volume.read(z=slice(z0, z0 + chunks[0]))
+		for j, y0 in enumerate(range(0, volume.shape[1], chunks[1])):
+			for k, x0 in enumerate(range(0, volume.shape[2], chunks[2])):
+				chunk = slab[:, y0:y0+chunks[1], x0:x0+chunks[2]]
+				if chunk.any(): # Empty chunks read as zeros
+					np.save(os.path.join(path, '{}.{}.{}.npy'.format(i, j, k)), chunk)
+	with open(os.path.join(path, 'meta.json'), 'w') as f:
+		json.dump({'shape': list(volume.shape), 'dtype': volume.dtype.str, 'chunks': list(chunks)}, f)
+	return ChunkedVolume(path)
+
+###################################################################################################
+def open_volume(path):
+	"""
+	Lazy volume of path: a chunked directory, a TIFF stack, or anything skimage reads (in memory).
+	Close it when done, e.g. with contextlib.closing.
+	"""
+	if os.path.isdir(path):
+		return ChunkedVolume(path)
+	if path.lower().endswith(('.tif', '.tiff')):
+		return TiffVolume(path)
+	import skimage.io
+	return ArrayVolume(skimage.io.imread(path))
+
+def read_volume(path, shape, crop=(0.5, 0.5, 0.5)):
+	"""
+	Read at most shape [z, y, x] voxels of the volume at path. Along every axis longer than
+	shape, the window starts at the fraction crop of the possible offsets.
+	"""
+	with contextlib.closing(open_volume(path)) as volume:
+		return read_window(volume, shape, crop)
+
+def window_start(n, size, u):
+	# First voxel of the window of size voxels at the fraction u of the offsets along an axis of n
+	return int(u * (n - size + 1)) if n > size else 0
+
+def read_window(volume, shape, crop=(0.5, 0.5, 0.5)):
+	# read_volume of an opened volume
+	index = []
+	for n, size, u in zip(volume.shape, shape, crop):
+		start = window_start(n, size, u)
+		index.append(slice(start, start + min(n, size)))
+	return volume.read(*index)
+
+def bounding_box(volume, slab=64):
+	"""
+	[(lo, hi)] along every axis of the non-zero voxels of volume [z, y, x] (an array or a lazy
+	volume), all (0, 0) when it is empty. Read slab by slab along the first axis.
+	"""
+	if isinstance(volume, np.ndarray):
+		volume = ArrayVolume(volume)
+	planes = np.zeros(volume.shape[0], dtype=bool)
+	rows   = np.zeros(volume.shape[1], dtype=bool)
+	cols   = np.zeros(volume.shape[2], dtype=bool)
+	for z0, data in slabs(volume, slab):
+		mask = data.reshape(data.shape[0], data.shape[1], -1).any(axis=-1)  # [z, y] rows with content
+		if not mask.any():
+			continue
+		planes[z0:z0+len(data)] = mask.any(axis=1)
+		rows |= mask.any(axis=0)
+		cols |= data[planes[z0:z0+len(data)]].any(axis=(0, 1))
+	if not planes.any():
+		return [(0, 0)] * 3
+	return [(int(np.argmax(m)), int(len(m) - np.argmax(m[::-1]))) for m in (planes, rows, cols)]
+
+def cache_location(path, cache_dir=None):
+	"""
+	Where to keep a file or directory derived from the data, path itself by default, or the
+	same absolute path under cache_dir (e.g. when the data is on a read-only mount).
+	"""
+	if cache_dir is None:
+		return path
+	return os.path.join(cache_dir, os.path.abspath(path).lstrip(os.sep))
+
+class VolumeIndex(object):
+	"""
+	Metadata of the volumes of a directory, kept in directory/.volume_index.json (see cache_location):
+	{name: {'mtime': ..., 'shape': [z, y, x], 'box': [[z0, z1], [y0, y1], [x0, x1]]}}
+	An entry is computed the first time it is asked for and again when its volume changes. The
+	index stays in memory when its file cannot be written.
+	"""
+	def __init__(self, directory, cache_dir=None):
+		self.filename = cache_location(os.path.join(directory, '.volume_index.json'), cache_dir)
+		self.lock = threading.Lock() # Entries are computed by the threads of the readers
+		self.entries = {}
+		if os.path.exists(self.filename):
+			with open(self.filename) as f:
+				self.entries = json.load(f)
+
+	def _update(self, path):
+		# Whether the entry of path had to be computed
+		name, mtime = os.path.basename(path.rstrip(os.sep)), os.path.getmtime(path)
+		entry = self.entries.get(name)
+		if entry is not None and entry['mtime'] == mtime:
+			return False
+		with contextlib.closing(open_volume(path)) as volume:
+			entry = {'mtime': mtime, 'shape': list(volume.shape), 'box': bounding_box(volume)}
+		with self.lock:
+			self.entries[name] = entry
+		return True
+
+	def entry(self, path):
+		if self._update(path):
+			self.save()
+		return self.entries[os.path.basename(path.rstrip(os.sep))]
+
+	def box(self, path):
+		return self.entry(path)['box']
+
+	def save(self):
+		if self.filename is None:
+			return
+		temporary = '{}.{}.{}.tmp'.format(self.filename, os.getpid(), threading.current_thread().ident)
+		try:
+			directory = os.path.dirname(self.filename)
+			if directory and not os.path.isdir(directory):
+				os.makedirs(directory)
+			with self.lock, open(temporary, 'w') as f:
+				json.dump(self.entries, f)
+			os.rename(temporary, self.filename)
+		except (IOError, OSError):
+			self.filename = None # Read-only, the entries stay in memory
+
+def slabs(volume, depth, reverse=False):
+	"""(z0, volume[z0:z0+depth]) for every slab of depth slices, from the back if reverse."""
+	starts = list(range(0, volume.shape[0], depth))
+	for z0 in (reversed(starts) if reverse else starts):
+		yield z0, volume.read(z=slice(z0, z0 + depth))
@@ -12,7 +12,7 @@ from vtk.util.numpy_support import vtk_to_numpy
 from vtk.util.vtkConstants import *
 
 
-def numpy2VTK(img,spacing=[1.0,1.0,1.0]):
+def numpy2VTK(img,spacing=[1.0,1.0,1.0],origin=[0.0,0.0,0.0]):
 	# evolved from code from Stou S.,
 	# on http://www.siafoo.net/snippet/314
 	importer = vtk.vtkImageImport()
@@ -34,12 +34,12 @@ def numpy2VTK(img,spacing=[1.0,1.0,1.0]):
 							extent[4], extent[4] + dim[0] - 1)
 
 	importer.SetDataSpacing( spacing[0], spacing[1], spacing[2])
-	importer.SetDataOrigin( 0,0,0 )
+	importer.SetDataOrigin( origin[0],origin[1],origin[2] ) # Where a cropped img sits in the full volume
 
 	return importer
 
-def VolumeRender(img, tf=[],spacing=[1.0,1.0,1.0]):
-	importer = numpy2VTK(img,spacing)
+def VolumeRender(img, tf=[],spacing=[1.0,1.0,1.0],origin=[0.0,0.0,0.0],blend='over',sample_step=1,shade=False):
+	importer = numpy2VTK(img,spacing,origin)
 
 	# Transfer Functions
 	opacity_tf = vtk.vtkPiecewiseFunction()
@@ -56,6 +56,15 @@ def VolumeRender(img, tf=[],spacing=[1.0,1.0,1.0]):
 	# working on the GPU
 	volMapper = vtk.vtkGPUVolumeRayCastMapper()
 	volMapper.SetInputConnection(importer.GetOutputPort())
+	# Projection along the rays, see VolumeCompositor.PROJECTION_MODES
+	if blend == 'mip':
+		volMapper.SetBlendModeToMaximumIntensity()
+	elif blend == 'minip':
+		volMapper.SetBlendModeToMinimumIntensity()
+	elif blend == 'average':
+		volMapper.SetBlendModeToAverageIntensity()
+	else:
+		volMapper.SetBlendModeToComposite()
 
 	# # The property describes how the data will look
 	# volProperty =  vtk.vtkVolumeProperty()
@@ -76,12 +85,22 @@ def VolumeRender(img, tf=[],spacing=[1.0,1.0,1.0]):
 	volProperty =  vtk.vtkVolumeProperty()
 	volProperty.SetColor(color_tf)
 	volProperty.SetScalarOpacity(opacity_tf)
-	# volProperty.ShadeOn()
+	if shade:
+		# Same coefficients as Shading.Shader
+		volProperty.ShadeOn()
+		volProperty.SetAmbient(0.3)
+		volProperty.SetDiffuse(0.7)
+		volProperty.SetSpecular(0.3)
+		volProperty.SetSpecularPower(16.0)
 	volProperty.SetInterpolationTypeToLinear()
 	
 	# Do the lines below speed things up?
 	pix_diag = 5.0
-	volMapper.SetSampleDistance(pix_diag / 1.0)    
+	# Coarser steps keep the opacity unit distance, the mapper corrects the opacity per sample.
+	# vtkGPUVolumeRayCastMapper has no hook for a 2D pre-integration table (see PreIntegration)
+	if sample_step > 1:
+		volMapper.SetAutoAdjustSampleDistances(0)
+	volMapper.SetSampleDistance(pix_diag / 1.0 * sample_step)    
 	volProperty.SetScalarOpacityUnitDistance(pix_diag) 
 	
 
@@ -91,7 +110,6 @@ def VolumeRender(img, tf=[],spacing=[1.0,1.0,1.0]):
 	
 	return [vol]
 
-
 def VolumeRenderToImage( actors ):
 	"""
 	Create a window, renderer, interactor, add the actors and start the thing